@@ -0,0 +1,414 @@
+import asyncio
+import gc
+import json
+import markovify
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import bot
+import format
+import model
+import recent
+
+
+# yields cleaned lines from every training file, cycling through the corpus forever
+def corpus_lines(root_dir='train'):
+    paths = []
+    for dir_path, dir_names, file_names in os.walk(root_dir):
+        paths += [os.path.join(dir_path, f) for f in sorted(file_names) if f.endswith('.txt')]
+
+    while True:
+        for path in paths:
+            with open(path, 'r', encoding='iso-8859-1') as f:
+                yield from format.clean_lines(f)
+
+
+# grows a model to each size and measures the mean cost of learning a single message at that size
+def bench_update_model(sizes=(1000, 10000, 100000, 500000), samples=500, state_size=2):
+    lines = corpus_lines()
+    m = model.Model(state_size=state_size)
+    results = []
+
+    for size in sizes:
+        while m.generator.sentence_count() < size:
+            m.update_model([next(lines) for i in range(1000)])
+
+        messages = [next(lines) for i in range(samples)]
+
+        start = time.perf_counter()
+        for message in messages:
+            m.update_model(message)
+        elapsed = time.perf_counter() - start
+
+        results.append((m.generator.sentence_count(), elapsed / samples))
+
+    return results
+
+
+# cleaned lines of a training file, or of every file in a training directory
+def dataset_lines(path):
+    paths = [path]
+    if os.path.isdir(path):
+        paths = [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith('.txt')]
+
+    lines = []
+    for p in paths:
+        with open(p, 'r', encoding='iso-8859-1') as f:
+            lines += format.clean_lines(f)
+
+    return lines
+
+
+def measure_memory(build):
+    tracemalloc.start()
+    built = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return built, size
+
+
+def freeze(text):
+    text.freeze()
+    return text
+
+
+# compares the memory held by a plain markovify.Text (dict chain plus parsed sentences) with model.Text (compact chain,
+# reverse chain and rejoined text) built from the same lines, learnable and frozen
+def bench_memory(datasets=('train/default.txt', 'train/pasta', 'train/prophet'), state_size=2):
+    results = []
+
+    for dataset in datasets:
+        lines = dataset_lines(dataset)
+
+        markovify_text, markovify_size = measure_memory(
+            lambda: markovify.Text(lines, state_size=state_size, well_formed=False))
+        compact_text, compact_size = measure_memory(
+            lambda: model.Text(lines, state_size=state_size, well_formed=False))
+        frozen_text, frozen_size = measure_memory(
+            lambda: freeze(model.Text(lines, state_size=state_size, well_formed=False)))
+
+        results.append((dataset, len(markovify_text.parsed_sentences), markovify_size, compact_size, frozen_size))
+
+    return results
+
+
+def time_train(dataset):
+    b = bot.Bot(0, '')
+
+    start = time.perf_counter()
+    b.train_on_files(dataset)
+    elapsed = time.perf_counter() - start
+
+    return b, elapsed
+
+
+# trains on each dataset with its cache cleared (cold), then again as a restarted bot would (warm): a new bot with no
+# shared models in memory, loading the snapshot the cold run cached
+def bench_train(datasets=('pasta', 'prophet')):
+    results = []
+
+    for dataset in datasets:
+        shutil.rmtree(f'{model.Model().cache_dir}{dataset}', ignore_errors=True)
+        b, cold = time_train(dataset)
+        sentences = b.model.generator.sentence_count()
+
+        del b
+        gc.collect()
+        model.shared_texts.clear()
+
+        b, warm = time_train(dataset)
+        results.append((dataset, sentences, cold, warm))
+
+    return results
+
+
+# format.text_cleaner as it was before its patterns were compiled and combined, to compare against
+def uncompiled_text_cleaner(text, remove_periods=True):
+    try:
+        text = re.sub(r'https?://.*[\r\n]*', '', text)
+        text = re.sub(r'@\S+', '', text)
+        text = re.sub(r'<@\S+', '', text)
+
+        for char in format.special_chars:
+            text = text.replace(char, '')
+        text = text.replace('\n', '.')
+
+        text = format.strip_question(text)
+
+        if remove_periods and random.randrange(0, 100) > 20:
+            if text[-1] == '.':
+                text = text[:-1]
+
+        text = format.censor_mage(text)
+    except:
+        pass
+
+    return text
+
+
+# raw non-empty lines of every training file
+def raw_lines(root_dir='train'):
+    lines = []
+    for dir_path, dir_names, file_names in os.walk(root_dir):
+        for f in sorted(file_names):
+            if f.endswith('.txt'):
+                with open(os.path.join(dir_path, f), 'r', encoding='iso-8859-1') as f_data:
+                    lines += [line for line in f_data if line.strip()]
+
+    return lines
+
+
+# cleaning throughput over the whole training corpus, before and after, in lines and MB per second
+def bench_clean(repeats=5):
+    lines = raw_lines()
+    size = sum(len(line) for line in lines) / 2**20
+    results = []
+
+    for name, clean in (('uncompiled', lambda: [uncompiled_text_cleaner(line) for line in lines]),
+                        ('text_cleaner', lambda: [format.text_cleaner(line) for line in lines]),
+                        ('clean_lines', lambda: list(format.clean_lines(lines)))):
+        best = None
+        for i in range(repeats):
+            start = time.perf_counter()
+            clean()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        results.append((name, len(lines) / best, size / best))
+
+    return results
+
+
+# mean cost of checking a new take against windows of remembered takes, as the old list and as recent.RecentTakes with
+# and without near-duplicate detection
+def bench_recent(sizes=(20, 1000, 10000), samples=1000):
+    lines = corpus_lines()
+    results = []
+
+    for size in sizes:
+        remembered = [next(lines) for i in range(size)]
+        takes = [next(lines) for i in range(samples)]
+
+        exact = recent.RecentTakes(size=size, near_duplicate_ratio=None)
+        near = recent.RecentTakes(size=size)
+        for take in remembered:
+            exact.add(take)
+            near.add(take)
+
+        timings = []
+        for window in (remembered, exact, near):
+            start = time.perf_counter()
+            for take in takes:
+                take in window
+            timings.append((time.perf_counter() - start) / samples)
+
+        results.append((size, *timings))
+
+    return results
+
+
+# stand-ins for the discord objects bot.Bot reads, so messages can be replayed without a connection
+class StubAuthor:
+
+    def __init__(self, author_id):
+        self.id = author_id
+        self.name = f'user{author_id}'
+        self.roles = []
+
+
+class StubMessage:
+
+    def __init__(self, content, author_id=0, channel_id=1):
+        self.content = content
+        self.author = StubAuthor(author_id)
+        self.channel = type('StubChannel', (), {'id': channel_id})()
+        self.mentions = []
+
+
+# resident memory of this process in bytes, from /proc where there is one, otherwise the peak from getrusage
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentiles(timings):
+    if not timings:
+        return {}
+
+    timings = sorted(timings)
+    pick = lambda q: timings[min(len(timings) - 1, int(q * len(timings)))]
+
+    return {'count': len(timings), 'mean': sum(timings) / len(timings), 'p50': pick(0.5), 'p95': pick(0.95),
+            'p99': pick(0.99), 'max': timings[-1]}
+
+
+async def timed_call(timings, call):
+    start = time.perf_counter()
+    result = await call
+    timings.append(time.perf_counter() - start)
+
+    return result
+
+
+# replays a dataset's lines as messages from a few stub users through a fresh bot, the way on_message drives it:
+# every message is learned, every take_every-th one is followed by a random take, every reply_every-th by a reply to
+# it and every rant_every-th by a rant. memory is sampled memory_samples times along the way, and the model is then
+# saved and loaded as a snapshot and as json
+async def replay(dataset, state_size=2, limit=None, take_every=10, reply_every=25, rant_every=200, memory_samples=10,
+                 users=20):
+    lines = dataset_lines(f'train/{dataset}')[:limit]
+    timings = {'learn': [], 'take': [], 'reply': [], 'rant': []}
+    memory = []
+
+    gc.collect()
+    model.shared_texts.clear()
+    start_rss = rss_bytes()
+
+    b = bot.Bot(0, '')
+    b.reset(state_size=state_size)
+    b.channel_id = 1
+
+    start = time.perf_counter()
+    for i, line in enumerate(lines, 1):
+        message = StubMessage(line, author_id=i % users)
+        await timed_call(timings['learn'], b.train(message))
+
+        if i % take_every == 0:
+            await timed_call(timings['take'], b.generate_take_async())
+        if i % reply_every == 0:
+            await timed_call(timings['reply'], b.generate_take_async(message=message))
+        if i % rant_every == 0:
+            await timed_call(timings['rant'], b.generate_rant_async())
+
+        if i % max(1, len(lines) // memory_samples) == 0:
+            memory.append((i, rss_bytes() - start_rss))
+    elapsed = time.perf_counter() - start
+
+    # let background refills finish so they don't run into the save
+    while b.refilling:
+        await asyncio.sleep(0.01)
+
+    persistence = {}
+    with tempfile.TemporaryDirectory() as root_dir:
+        b.model.root_dir = f'{root_dir}/'
+
+        for fmt in ('snapshot', 'json'):
+            save_start = time.perf_counter()
+            b.model.save_model(model_name=fmt, fmt=fmt)
+            save_time = time.perf_counter() - save_start
+            size = sum(os.path.getsize(f'{root_dir}/{f}') for f in os.listdir(root_dir) if f.startswith(f'{fmt}.'))
+
+            model.shared_texts.clear()
+            loaded = model.Model(state_size=state_size)
+            loaded.root_dir = b.model.root_dir
+
+            load_start = time.perf_counter()
+            loaded.load_model(model_name=fmt)
+            load_time = time.perf_counter() - load_start
+
+            persistence[fmt] = {'save': save_time, 'load': load_time, 'bytes': size}
+
+    return {'dataset': dataset, 'state_size': state_size, 'messages': len(lines),
+            'sentences': b.model.generator.sentence_count(), 'elapsed': elapsed,
+            'messages_per_second': len(lines) / elapsed if elapsed else None,
+            'latency': {name: percentiles(t) for name, t in timings.items()},
+            'memory_growth': memory, 'persistence': persistence}
+
+
+# replays every dataset at every state size and writes the results, with what they were run on, to out as json
+def bench_replay(datasets=('pasta', 'prophet'), state_sizes=(2, 3), limit=None, out='bench_replay.json'):
+    results = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+               'platform': platform.platform(), 'limit': limit, 'runs': []}
+
+    for dataset in datasets:
+        for state_size in state_sizes:
+            results['runs'].append(asyncio.run(replay(dataset, state_size=state_size, limit=limit)))
+
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    return results
+
+
+# the ratio of each run's numbers in new to the same run's in old, i.e. 0.5 for twice as fast
+def compare_replays(old_path, new_path):
+    with open(old_path) as f:
+        old = {(run['dataset'], run['state_size']): run for run in json.load(f)['runs']}
+    with open(new_path) as f:
+        new = {(run['dataset'], run['state_size']): run for run in json.load(f)['runs']}
+
+    rows = []
+    for key in new.keys() & old.keys():
+        ratios = {name: new[key]['latency'][name]['p50'] / old[key]['latency'][name]['p50']
+                  for name in new[key]['latency'] if new[key]['latency'][name] and old[key]['latency'].get(name)}
+        ratios['save'] = new[key]['persistence']['snapshot']['save'] / old[key]['persistence']['snapshot']['save']
+        ratios['load'] = new[key]['persistence']['snapshot']['load'] / old[key]['persistence']['snapshot']['load']
+        rows.append((*key, ratios))
+
+    return sorted(rows)
+
+
+if __name__ == '__main__':
+    bench = sys.argv[1] if len(sys.argv) > 1 else 'update'
+
+    if bench == 'update':
+        sizes = [int(x) for x in sys.argv[2:]] or (1000, 10000, 100000, 500000)
+
+        print('sentences  us/message')
+        for sentences, per_message in bench_update_model(sizes=sizes):
+            print(f'{sentences:>9}  {per_message * 1e6:>10.1f}')
+    elif bench == 'memory':
+        datasets = sys.argv[2:] or ('train/default.txt', 'train/pasta', 'train/prophet')
+
+        print(f'{"dataset":<20} {"sentences":>9} {"markovify MB":>12} {"compact MB":>10} {"frozen MB":>9}')
+        for dataset, sentences, markovify_size, compact_size, frozen_size in bench_memory(datasets=datasets):
+            print(f'{dataset:<20} {sentences:>9} {markovify_size / 2**20:>12.2f} {compact_size / 2**20:>10.2f} '
+                  f'{frozen_size / 2**20:>9.2f}')
+    elif bench == 'train':
+        datasets = sys.argv[2:] or ('pasta', 'prophet')
+
+        print(f'{"dataset":<10} {"sentences":>9} {"cold s":>8} {"warm s":>8}')
+        for dataset, sentences, cold, warm in bench_train(datasets=datasets):
+            print(f'{dataset:<10} {sentences:>9} {cold:>8.3f} {warm:>8.3f}')
+    elif bench == 'clean':
+        print(f'{"cleaner":<12} {"lines/s":>10} {"MB/s":>6}')
+        for name, lines_per_second, mb_per_second in bench_clean():
+            print(f'{name:<12} {lines_per_second:>10.0f} {mb_per_second:>6.2f}')
+    elif bench == 'recent':
+        sizes = [int(x) for x in sys.argv[2:]] or (20, 1000, 10000)
+
+        print(f'{"window":>6} {"list us":>8} {"exact us":>8} {"near us":>8}')
+        for size, list_check, exact_check, near_check in bench_recent(sizes=sizes):
+            print(f'{size:>6} {list_check * 1e6:>8.2f} {exact_check * 1e6:>8.2f} {near_check * 1e6:>8.2f}')
+    elif bench == 'replay':
+        datasets = [x for x in sys.argv[2:] if not x.isdigit()] or ('pasta', 'prophet')
+        limit = next((int(x) for x in sys.argv[2:] if x.isdigit()), None)
+
+        results = bench_replay(datasets=datasets, limit=limit)
+
+        print(f'{"dataset":<10} {"state":>5} {"msgs/s":>8} {"take p50":>8} {"take p99":>8} {"reply p50":>9} '
+              f'{"rant p50":>8} {"mem MB":>7} {"save s":>7} {"load s":>7}')
+        for run in results['runs']:
+            latency = run['latency']
+            growth = run['memory_growth'][-1][1] / 2**20 if run['memory_growth'] else 0
+            print(f'{run["dataset"]:<10} {run["state_size"]:>5} {run["messages_per_second"]:>8.0f} '
+                  f'{latency["take"].get("p50", 0) * 1e3:>8.2f} {latency["take"].get("p99", 0) * 1e3:>8.2f} '
+                  f'{latency["reply"].get("p50", 0) * 1e3:>9.2f} {latency["rant"].get("p50", 0) * 1e3:>8.2f} '
+                  f'{growth:>7.1f} {run["persistence"]["snapshot"]["save"]:>7.3f} '
+                  f'{run["persistence"]["snapshot"]["load"]:>7.3f}')
+        print('latencies in ms. results written to bench_replay.json')
+    elif bench == 'compare':
+        for dataset, state_size, ratios in compare_replays(sys.argv[2], sys.argv[3]):
+            print(f'{dataset:<10} {state_size:>5} ' + ' '.join(f'{name} {ratio:.2f}x' for name, ratio in ratios.items()))
@@ -1,17 +1,31 @@
-import json
+import asyncio
+import collections
+import hashlib
 import math
 import os
 import random
-import requests
 import time
 
 import format
+import gifs
+import metrics
 import model
+import recent
+import seeds
+import workers
 
 
 class Bot:
 
+    # attributes saved by get_settings, besides the take and seed windows and where the model came from
+    setting_names = ('channel_id', 'random_wait', 'msgs_wait', 'mention_wait', 'rant_size', 'rant_chance', 'gif_chance',
+                     'takes_enabled', 'replies_enabled', 'gifs_enabled', 'learn', 'restricted', 'learn_limit',
+                     'current_data_set')
+
     def __init__(self, guild_id, TENOR_TOKEN):
+        # most sentences learned from conversation that the model keeps, None for no limit
+        self.learn_limit = None
+
         self.model = model.Model()
 
         self.channel_id = ''
@@ -27,8 +41,18 @@ class Bot:
         self.gif_chance = 1
 
         self.can_generate_unique_takes = False
-        self.max_previous_takes = 20
-        self.previous_takes = []
+        self.previous_takes = recent.RecentTakes(size=20)
+
+        # pre-generated sentences for unseeded takes and rants, refilled in the background
+        self.take_buffer_size = 25
+        self.take_buffer_chunk = 5
+        self.take_buffer = collections.deque()
+        self.refilling = False
+        # after a refill adds nothing, refills wait refill_backoff seconds (doubling up to refill_max_backoff) so a
+        # model that can't make new sentences isn't walked on every message
+        self.refill_backoff = 0
+        self.refill_max_backoff = 300
+        self.refill_after = 0
 
         self.takes_enabled = True
         self.replies_enabled = True
@@ -41,8 +65,111 @@ class Bot:
         self.user_mention_times = {}
         self.time_of_random = time.time() - self.random_wait*60
         self.msgs_waited = 0
-        self.previous_messages = []
+        # words from recent conversation, weighted by use, for seeding takes and gifs
+        self.seed_index = seeds.SeedIndex(size=10)
+
+        # this guild's own boring words, kept in filters/<guild id>.txt and used on top of filter.txt
+        self.filters_dir = 'filters/'
+        self.custom_stopwords = frozenset()
+        self.stopwords = None
+        self.load_stopwords()
+
+        # how the current model was made, to make it again after a restart: ['train', train_dir, file, weights],
+        # ['load', model_name], ['learned', model_name, source] for one saved by save_learned, or None for a fresh model
+        # that hasn't learned anything worth saving. a restored model is only made again when it's first used
+        self.model_source = None
+        self.restore_pending = False
+        # messages learned since the model was made, which a restored model wouldn't have
+        self.learned = 0
+
+        # serializes this guild's model work in the worker pool
+        self.lock = asyncio.Lock()
+
+    async def run_serialized(self, func, *args, **kwargs):
+        async with self.lock:
+            if self.restore_pending:
+                self.restore_pending = False
+                await workers.run(self.restore_model)
+
+            return await workers.run(func, *args, **kwargs)
+
+    async def generate_take_async(self, message=None):
+        take = await self.run_serialized(self.generate_take, message=message)
+        self.schedule_refill(drained=True)
+        return take
+
+    async def generate_rant_async(self, rant_size=None):
+        rant = await self.run_serialized(self.generate_rant, rant_size=rant_size)
+        self.schedule_refill(drained=True)
+        return rant
+
+    async def train_on_files_async(self, train_dir=None, file=None, weights=None):
+        self.restore_pending = False
+        ret = await self.run_serialized(self.train_on_files, train_dir=train_dir, file=file, weights=weights)
+        self.schedule_refill()
+        return ret
+
+    async def load_async(self, model_name=None):
+        self.restore_pending = False
+        ret = await self.run_serialized(self.load, model_name=model_name)
+        self.schedule_refill()
+        return ret
+
+    async def reset_async(self):
+        self.restore_pending = False
+        return await self.run_serialized(self.reset)
+
+    # refills the take buffer in the background once the model is ready, or after a take or rant (drained) used it up
+    def schedule_refill(self, drained=False):
+        if (not self.refilling) and (self.channel_id != '') and (len(self.take_buffer) < self.take_buffer_size) \
+                and (self.can_generate_unique_takes or drained) and (time.monotonic() >= self.refill_after):
+            self.refilling = True
+            asyncio.ensure_future(self.refill_take_buffer())
+
+    # fills the buffer a chunk at a time so takes and replies for this guild can take the lock in between
+    async def refill_take_buffer(self):
+        try:
+            while len(self.take_buffer) < self.take_buffer_size:
+                if await self.run_serialized(self.fill_take_buffer, count=self.take_buffer_chunk) == 0:
+                    self.refill_backoff = min(self.refill_max_backoff, max(1, self.refill_backoff * 2))
+                    self.refill_after = time.monotonic() + self.refill_backoff
+                    break
+
+                self.refill_backoff = 0
+        finally:
+            self.refilling = False
+
+    # adds up to count new sentences to the take buffer that have not been posted or buffered already, returning how
+    # many were added
+    @metrics.timed('refill')
+    def fill_take_buffer(self, count=None, max_tries=3):
+        if count is None:
+            count = self.take_buffer_size
+
+        added = 0
+        for i in range(count * max_tries):
+            if (added >= count) or (len(self.take_buffer) >= self.take_buffer_size):
+                break
+
+            sentence = self.model.make_sentence(exclude=self.previous_takes)
+            if (sentence != self.model.no_take_text) and (sentence not in self.take_buffer) \
+                    and (format.text_cleaner(sentence) not in self.previous_takes):
+                self.take_buffer.append(sentence)
+                added += 1
 
+        return added
+
+    # returns a buffered sentence that has not been posted since it was generated, or None if the buffer is empty
+    def pop_take(self):
+        while len(self.take_buffer) > 0:
+            sentence = self.take_buffer.popleft()
+
+            if format.text_cleaner(sentence) not in self.previous_takes:
+                return sentence
+
+        return None
+
+    @metrics.timed('take')
     def generate_take(self, message=None):
         # do not generate take if:
         # 1. channel is not set
@@ -55,23 +182,31 @@ class Bot:
         else:
             if message is None:
                 # probabilistically pick a random word from recent conversation to seed a take
-                if random.random() < 0.8 and (len(self.previous_messages)>5):
+                if random.random() < 0.8 and (len(self.seed_index)>5):
                     seed_text = self.get_seed_word_from_previous_msgs()
                 else:
                     seed_text = None
 
-                take_text = self.model.make_sentence(tries=50, message=seed_text)
+                take_text = None
+                if seed_text is None:
+                    take_text = self.pop_take()
+                    metrics.count('buffered_takes' if take_text is not None else 'buffer_misses', self.guild_id)
+
+                if take_text is None:
+                    take_text = self.model.make_sentence(tries=50, message=seed_text, exclude=self.previous_takes)
                 take_text = self.ensure_unique(format.text_cleaner(take_text))
             else:
                 # seed the take with the message content
                 take_text = self.model.make_sentence(tries=50,
                                                      message=message.content,
-                                                     smart_eligible=self.enough_unique_words(message.content))
+                                                     smart_eligible=self.enough_unique_words(message.content),
+                                                     exclude=self.previous_takes)
                 take_text = self.ensure_unique(format.text_cleaner(take_text), message=message.content)
 
             self.log_take(take_text)
 
-            take_text = format.add_suffix(format.text_cleaner(take_text))
+            with metrics.timer('clean', self.guild_id):
+                take_text = format.add_suffix(format.text_cleaner(take_text))
 
             if message is not None:
                 # sometimes add "because" to the beginning, if it's a "why" question
@@ -93,6 +228,7 @@ class Bot:
 
             return take_text
 
+    @metrics.timed('rant')
     def generate_rant(self, rant_size=None, trigger_icd=False):
         if rant_size is None:
             rant_size = self.rant_size
@@ -104,7 +240,11 @@ class Bot:
             rant = ''
 
             for i in range(rant_size):
-                sentence = self.ensure_unique(self.model.make_sentence())
+                sentence = self.pop_take()
+                if sentence is None:
+                    sentence = self.model.make_sentence(exclude=self.previous_takes)
+
+                sentence = self.ensure_unique(sentence)
                 sentence = format.text_cleaner(sentence, remove_periods=False)
                 sentence = format.add_period_if_needed(sentence)
                 self.log_take(sentence)
@@ -121,44 +261,36 @@ class Bot:
             else:
                 pass
 
-    def generate_gif(self, seed=None):
+    async def generate_gif(self, seed=None):
         num_gifs_to_request = 8
 
         if seed is None:
-            seed = self.get_seed_word_from_previous_msgs()
+            seed = await self.run_serialized(self.get_seed_word_from_previous_msgs)
 
             if seed is None:
                 return
 
-        seed = format.remove_boring_words(seed)
+        seed = format.remove_boring_words(seed, self.stopwords)
         seed = random.choices(seed, k=min(3, len(seed)))
 
-        r = requests.get(
-            "https://g.tenor.com/v1/search?q=%s&key=%s&limit=%s" % (seed, self.TENOR_TOKEN, num_gifs_to_request))
-
-        if r.status_code == 200:
-            top_5gifs = json.loads(r.content)
-            gif_urls = [result['media'][0]['gif']['url'] for result in top_5gifs['results']]
+        with metrics.timer('gif', self.guild_id):
+            gif_urls = await gifs.search(seed, self.TENOR_TOKEN, limit=num_gifs_to_request)
 
+        if gif_urls:
             return random.choice(gif_urls)
         else:
             return
 
     def log_take(self, text):
-        if len(self.previous_takes) >= self.max_previous_takes:
-            self.previous_takes = self.previous_takes[1:]
-
-        self.previous_takes.append(text)
+        self.previous_takes.add(text)
 
-    def ensure_unique(self, text, max_tries=20, message=None):
-        # do not re-use previous takes
-        tries = 0
-        while (text in self.previous_takes) & (tries < max_tries):
-            if message is None:
-                text = self.model.make_sentence()
-            else:
-                text = self.model.make_sentence(message=message)
-            tries += 1
+    @metrics.timed('ensure_unique')
+    def ensure_unique(self, text, max_tries=50, message=None):
+        # do not re-use previous takes. generation already skips them, so this only catches a take that matches once
+        # cleaned, and retries within a single bounded number of walks
+        if text in self.previous_takes:
+            metrics.count('unique_retries', self.guild_id)
+            text = self.model.make_sentence(message=message, tries=max_tries, exclude=self.previous_takes)
 
         return text
 
@@ -172,17 +304,21 @@ class Bot:
         status = f'**Enabled features**: {", ".join(str(x) for x in self.get_enabled_functions())}\n' \
                  f'**Learning**: {self.learn}\n' \
                  f'**Ignore restricted roles**: {self.restricted}\n' \
-                 f'**Parsed sentences**: {len(self.model.generator.parsed_sentences)}\n' \
+                 f'**Parsed sentences**: {self.model.generator.sentence_count()}\n' \
+                 f'**Ready**: {self.can_generate_unique_takes}\n' \
                  f'**Chain**: {self.model.state_size}\n' \
                  f'**Data set**: {self.current_data_set}\n' \
                  f'**Mention reply cooldown** ({author.name}): {self.get_remaining_cooldown(author=author, string=True)} of {math.floor(self.mention_wait)}m\n' \
                  f'**Random take cooldown**: {self.get_remaining_cooldown(string=True)} of {math.floor(self.random_wait)}m\n' \
                  f'**Rant chance**: {self.rant_chance}%\n' \
                  f'**Rant size**: {self.rant_size}\n' \
-                 f'**Gif chance**: {self.gif_chance}%\n'
+                 f'**Gif chance**: {self.gif_chance}%\n' \
+                 f'**Take window**: {self.previous_takes.size}\n' \
+                 f'**Learn limit**: {self.learn_limit}\n' \
+                 f'**Seed window**: {self.seed_index.size}\n'
         return status
 
-    def train_on_files(self, train_dir=None, file=None):
+    def train_on_files(self, train_dir=None, file=None, weights=None):
         if train_dir is None:
             full_train_dir = self.training_root_dir
         else:
@@ -196,35 +332,51 @@ class Bot:
         else:
             state_size = 2
 
-        self.reset(state_size=state_size)
-
-        training_files = [f for f in os.listdir(full_train_dir) if f.endswith('.txt')]
-
-        for f in training_files:
-            training_file_path = f'{full_train_dir}/{f}'
+        if weights is None:
+            weights = {}
 
-            lines = []
-
-            if (file is None) or (f == file):
-                with open(training_file_path, 'r', encoding='iso-8859-1') as f_data:
-                    try:
-                        for line in f_data:
+        self.reset(state_size=state_size)
 
-                            if line.strip():
-                                clean_line = format.text_cleaner(line)
+        # file can be a single file name or a list of them
+        if isinstance(file, str):
+            file = [file]
 
-                                if clean_line != '':
-                                    lines.append(clean_line)
-                    except:
-                        pass
+        training_files = [f for f in os.listdir(full_train_dir) if f.endswith('.txt') and ((file is None) or (f in file))]
+        corpus = ((self.read_training_file(f'{full_train_dir}/{f}'), weights.get(f, 1)) for f in training_files)
 
-                self.model.update_model(lines)
+        # guilds training on the same files with the same weights share one model, so it's only built once
+        content_hash = self.hash_training_files(full_train_dir, training_files, weights)
+        self.model.build_model(corpus, name=full_train_dir, content_hash=content_hash, files=file)
 
         # in trained mode, disable further learning and ascension
         self.learn = False
         if train_dir != self.training_root_dir:
             self.current_data_set = train_dir
 
+        self.model_source = ['train', train_dir, file, weights]
+        self.can_generate_unique_takes = self.model.is_ready()
+
+    # hashes the names, weights and contents of the training files, so edited files make a new model
+    def hash_training_files(self, full_train_dir, training_files, weights):
+        content_hash = hashlib.sha1()
+
+        for f in sorted(training_files):
+            content_hash.update(f'{f}\0{weights.get(f, 1)}\0'.encode())
+
+            with open(f'{full_train_dir}/{f}', 'rb') as f_data:
+                for chunk in iter(lambda: f_data.read(1 << 20), b''):
+                    content_hash.update(chunk)
+
+        return content_hash.hexdigest()
+
+    # streams the cleaned, non-empty lines of a training file
+    def read_training_file(self, training_file_path):
+        with open(training_file_path, 'r', encoding='iso-8859-1') as f_data:
+            try:
+                yield from format.clean_lines(f_data)
+            except:
+                pass
+
     def reset(self, state_size=2):
         self.current_data_set = 'none'
         self.learn = True
@@ -232,26 +384,139 @@ class Bot:
         self.can_generate_unique_takes = False
 
         self.model = model.Model(state_size=state_size)
+        self.model.learn_limit = self.learn_limit
+        self.model.stopwords = self.stopwords
+        self.model_source = None
+        self.learned = 0
+        self.take_buffer.clear()
+        self.refill_backoff = 0
+        self.refill_after = 0
+
+    def load(self, model_name=None):
+        self.reset()
+        self.current_data_set = 'default' if model_name is None else model_name
+
+        ret = self.model.load_model(model_name=model_name)
+        if ret is not None:
+            self.model_source = ['load', model_name]
+            self.can_generate_unique_takes = self.model.is_ready()
+
+        return ret
+
+    # the model is looked up when this runs, not when it's queued, in case it's being restored
+    def save_model(self, model_name=None, fmt='snapshot'):
+        return self.model.save_model(model_name=model_name, fmt=fmt)
+
+    def set_learn_limit(self, learn_limit):
+        self.learn_limit = learn_limit
+        self.model.learn_limit = learn_limit
+        self.model.generator.set_capacity(learn_limit)
+
+    def get_settings(self):
+        settings = {name: getattr(self, name) for name in self.setting_names}
+        settings['take_window'] = [self.previous_takes.size, self.previous_takes.near_duplicate_ratio]
+        settings['seed_window'] = self.seed_index.size
+        settings['model_source'] = self.model_source
+
+        return settings
+
+    # applies settings from get_settings, i.e. ones saved before a restart. settings missing from older saves keep their
+    # defaults. the model they were using is made again the next time the model is used
+    def apply_settings(self, settings):
+        for name in self.setting_names:
+            if name in settings:
+                setattr(self, name, settings[name])
+
+        if 'take_window' in settings:
+            self.previous_takes.resize(settings['take_window'][0])
+            self.previous_takes.near_duplicate_ratio = settings['take_window'][1]
+        if 'seed_window' in settings:
+            self.seed_index.resize(settings['seed_window'])
+
+        self.model.learn_limit = self.learn_limit
+        self.model_source = settings.get('model_source')
+        self.restore_pending = self.model_source is not None
+
+    # saves a model that's learned from conversation since it was made, so it can be restored with what it learned. only
+    # the sentences it learned are saved, and it's restored by making the shared data set or saved model it learned on
+    # top of again (or a fresh model, if it had none) and learning them. they're learned like any other, so the learn
+    # limit keeps forgetting them
+    def save_learned(self):
+        model_name = f'guild-{self.guild_id}'
+        base_source = self.model_source
+
+        if (base_source is not None) and (base_source[0] == 'learned'):
+            base_source = base_source[2]
+
+        if self.model.save_learned(model_name) is not None:
+            self.model_source = ['learned', model_name, base_source]
+            self.learned = 0
+
+    # makes the model from model_source again, keeping whether the bot was learning and the data set it was on. a data
+    # set or saved model that's gone leaves the bot untrained
+    @metrics.timed('restore')
+    def restore_model(self):
+        learn = self.learn
+        data_set = self.current_data_set
+
+        try:
+            restored = self.make_model(self.model_source)
+        except:
+            restored = False
+
+        if restored:
+            self.current_data_set = data_set
+        else:
+            self.reset()
+
+        self.learn = learn
+
+    # makes the model from a model_source, returning whether it could
+    def make_model(self, source):
+        if source[0] == 'load':
+            return self.load(model_name=source[1]) is not None
+        elif source[0] == 'learned':
+            if source[2] is None:
+                self.reset()
+            elif not self.make_model(source[2]):
+                return False
+
+            if self.model.load_learned(source[1]) is None:
+                return False
+
+            self.model_source = source
+            self.can_generate_unique_takes = self.model.is_ready()
+            return True
+        else:
+            self.train_on_files(*source[1:])
+            return True
 
     # adds message to markov model and checks if the model knows enough to generate multiple unique outputs
     async def train(self, message):
+        await self.run_serialized(self.learn_message, message.content)
+        self.schedule_refill()
+
+    @metrics.timed('learn')
+    def learn_message(self, text):
+        # the seed index is only touched under the guild's lock, as takes read it from the worker pool
+        self.seed_index.add(text)
+
         # incorporate the message into the model if learning is enabled and the message is long enough to learn from
-        if self.learn & (len(message.content.split()) > self.model.generator.state_size):
-            self.model.update_model(message.content)
+        if self.learn & (len(text.split()) > self.model.generator.state_size):
+            self.model.update_model(text)
+            self.learned += 1
 
-        # set readiness flag
-        self.can_generate_unique_takes = self.test_take_readiness()
+        # set readiness flag from the chain statistics. once the model is ready, do not check again unless reset
+        if not self.can_generate_unique_takes:
+            with metrics.timer('readiness', self.guild_id):
+                self.can_generate_unique_takes = self.model.is_ready()
 
-    # if the model can spit out test_size unique takes, its model is "ready". once readiness is determined, do not check
-    # again unless reset
+    # diagnostic for $readiness: checks whether the model can actually spit out test_size unique takes
     def test_take_readiness(self, test_size=15):
-        if not self.can_generate_unique_takes:
-            takes = [self.model.make_sentence() for x in range(test_size)]
-            all_takes_unique = len(takes) == len(set(takes))
+        takes = [self.model.make_sentence() for x in range(test_size)]
+        all_takes_unique = len(takes) == len(set(takes))
 
-            return all_takes_unique
-        else:
-            return True
+        return all_takes_unique
 
     def get_remaining_cooldown(self, author=None, string=False):
         if author is None:
@@ -268,13 +533,27 @@ class Bot:
         else: # return string of minutes and seconds
             return format.time_to_text(sec_remaining)
 
-    def get_seed_word_from_previous_msgs(self):
-        seed_candidates = [msg for msg in self.previous_messages[4:] if len(msg.split(' ')) > 5]
+    def stopwords_path(self):
+        return f'{self.filters_dir}{self.guild_id}.txt'
 
-        if len(seed_candidates) > 0:
-            return random.choice(seed_candidates)
-        else:
-            return None
+    # rereads this guild's boring words, so they can be changed without a restart
+    def load_stopwords(self):
+        self.custom_stopwords = format.load_stopwords(self.stopwords_path())
+        self.stopwords = format.boring_words | self.custom_stopwords
+
+        self.model.stopwords = self.stopwords
+        self.seed_index.stopwords = self.stopwords
+
+    def save_stopwords(self, words):
+        os.makedirs(self.filters_dir, exist_ok=True)
+
+        with open(self.stopwords_path(), 'w', encoding='utf-8') as f:
+            f.write(''.join(f'{word}\n' for word in sorted(words)))
+
+        self.load_stopwords()
+
+    def get_seed_word_from_previous_msgs(self):
+        return self.seed_index.seed_words()
 
     def get_enabled_functions(self):
         enabled = []
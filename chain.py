@@ -0,0 +1,702 @@
+import bisect
+import collections
+import itertools
+import json
+import random
+from array import array
+
+from markovify.chain import BEGIN, END
+
+# states are packed into a single int of token ids, TOKEN_BITS bits per token
+TOKEN_BITS = 21
+MAX_TOKENS = 1 << TOKEN_BITS
+TOKEN_MASK = MAX_TOKENS - 1
+
+BEGIN_ID = 0
+END_ID = 1
+
+# rows with at least this many follows keep a dict of follow positions
+ROW_POSITIONS_MIN = 16
+
+
+class Vocab:
+
+    def __init__(self):
+        self.tokens = [BEGIN, END]
+        self.token_ids = {BEGIN: BEGIN_ID, END: END_ID}
+
+    def intern(self, word):
+        token_id = self.token_ids.get(word)
+
+        if token_id is None:
+            token_id = len(self.tokens)
+            if token_id >= MAX_TOKENS:
+                raise ValueError(f'Chain vocabulary is limited to {MAX_TOKENS} words')
+
+            self.tokens.append(word)
+            self.token_ids[word] = token_id
+
+        return token_id
+
+    @classmethod
+    def from_tokens(cls, tokens):
+        vocab = cls()
+        vocab.tokens = list(tokens)
+        vocab.token_ids = {token: token_id for token_id, token in enumerate(vocab.tokens)}
+
+        return vocab
+
+
+# an overlay chain's own vocab on top of its shared base's. the base's words keep their ids and new words are numbered
+# after them, so the words a guild learns never reach the base's vocab (or any other guild's) and go with its model
+class OverlayVocab(Vocab):
+
+    def __init__(self, base):
+        self.base = base
+        self.tokens = OverlayTokens(base.tokens)
+        self.token_ids = collections.ChainMap({}, base.token_ids)
+
+
+class OverlayTokens:
+
+    def __init__(self, base):
+        self.base = base
+        self.base_length = len(base)
+        self.own = []
+
+    def __getitem__(self, token_id):
+        if token_id < self.base_length:
+            return self.base[token_id]
+
+        return self.own[token_id - self.base_length]
+
+    def __len__(self):
+        return self.base_length + len(self.own)
+
+    def __iter__(self):
+        return itertools.chain(itertools.islice(self.base, self.base_length), self.own)
+
+    def append(self, token):
+        self.own.append(token)
+
+
+# markov chain over interned token ids, a fraction of the size of markovify's dicts of string tuples. walks take and
+# return words, like markovify.Chain. subclasses store the transitions
+class BaseChain:
+    frozen = False
+
+    def __init__(self, state_size, vocab=None):
+        if state_size * TOKEN_BITS > 64:
+            raise ValueError(f'State size is limited to {64 // TOKEN_BITS}')
+
+        self.state_size = state_size
+        self.vocab = vocab or Vocab()
+
+    def pack(self, ids):
+        key = 0
+        for i, token_id in enumerate(ids):
+            key |= token_id << (TOKEN_BITS * i)
+        return key
+
+    def unpack(self, key):
+        return tuple(self.vocab.tokens[(key >> (TOKEN_BITS * i)) & TOKEN_MASK] for i in range(self.state_size))
+
+    def move(self, state):
+        return self.vocab.tokens[self.move_id(self.pack([self.vocab.token_ids[w] for w in state]))]
+
+    def gen(self, init_state=None):
+        if init_state is None:
+            key = 0
+        else:
+            key = self.pack([self.vocab.token_ids[w] for w in init_state])
+
+        shift = TOKEN_BITS * (self.state_size - 1)
+
+        while True:
+            next_id = self.move_id(key)
+            if next_id == END_ID:
+                break
+            yield self.vocab.tokens[next_id]
+            key = (key >> TOKEN_BITS) | (next_id << shift)
+
+    def walk(self, init_state=None):
+        return list(self.gen(init_state))
+
+    # whether the chain has a state starting with word
+    def knows(self, word):
+        token_id = self.vocab.token_ids.get(word)
+        return (token_id is not None) and (len(self.index_keys(token_id)) > 0)
+
+    # states (as word tuples) that start with word, ignoring BEGIN
+    def states_with(self, word):
+        token_id = self.vocab.token_ids.get(word)
+        return [] if token_id is None else [self.unpack(key) for key in self.index_keys(token_id)]
+
+    def random_state_with(self, word):
+        token_id = self.vocab.token_ids.get(word)
+        keys = () if token_id is None else self.index_keys(token_id)
+        return self.unpack(random.choice(keys)) if keys else None
+
+    # weighted number of runs in the chain
+    def sentence_count(self):
+        return self.begin_cumdist[-1] if self.begin_cumdist else 0
+
+    # average number of distinct follows per state. a chain that can only retrace its input sits near 1
+    def branching_factor(self):
+        state_count = self.state_count()
+        return self.transition_count / state_count if state_count else 0
+
+    # (state key, follow items) for every state but the begin state, in key order
+    def sorted_rows(self):
+        for key in sorted(self.state_keys()):
+            yield key, self.row_items(key)
+
+    # the chain as markovify's dict of state tuples to {follow: count} dicts
+    def to_model(self):
+        tokens = self.vocab.tokens
+        model = {(BEGIN,) * self.state_size: {tokens[f]: c for f, c in self.begin_items()}}
+
+        for key in self.state_keys():
+            model[self.unpack(key)] = {tokens[f]: c for f, c in self.row_items(key)}
+
+        return model
+
+    # dumps the chain in markovify's json format
+    def to_json(self):
+        return json.dumps(list(self.to_model().items()))
+
+    @classmethod
+    def from_json(cls, json_thing):
+        obj = json.loads(json_thing) if isinstance(json_thing, str) else json_thing
+
+        if isinstance(obj, list):
+            rehydrated = {tuple(item[0]): item[1] for item in obj}
+        elif isinstance(obj, dict):
+            rehydrated = obj
+        else:
+            raise ValueError('Object should be dict or list')
+
+        state_size = len(list(rehydrated.keys())[0])
+
+        chain = Chain(None, state_size, model=rehydrated)
+        return chain.freeze() if cls is FrozenChain else chain
+
+
+# chain that can learn. each state is a packed int mapping to its follows: most states only ever have one, stored as a
+# single int of (count, follow id), and the rest get an array of interleaved (follow id, count) pairs
+class Chain(BaseChain):
+
+    def __init__(self, corpus, state_size, model=None, indexed=True, vocab=None):
+        super().__init__(state_size, vocab=vocab)
+
+        self.rows = {}
+        self.row_positions = {}
+
+        # the begin state gains a follow with nearly every run, so it keeps its counts in a dict, plus a sampling cache
+        # that may hold the same word more than once so each new run is appended instead of re-summing every begin word
+        self.begin_counts = {}
+        self.begin_choices = array('q')
+        self.begin_cumdist = array('q')
+        # set when forgetting lowers a begin count, which the append-only cache can't do, so it's rebuilt when next used
+        self.begin_stale = False
+
+        # number of distinct (state, follow) pairs, kept up to date while learning so readiness is cheap to check
+        self.transition_count = 0
+
+        # maps each word id to the states that start with it (ignoring BEGIN), so seeding a sentence with a word doesn't
+        # have to scan every state
+        self.index = {} if indexed else None
+
+        if model is not None:
+            for state, follows in model.items():
+                key = self.pack([self.vocab.intern(w) for w in state])
+
+                for follow, count in follows.items():
+                    self.add_transition(key, self.vocab.intern(follow), count)
+
+            self.compile_begin()
+
+        if corpus is not None:
+            for run in corpus:
+                self.learn(run)
+
+    # rebuilds the begin sampling cache with one entry per begin word
+    def compile_begin(self):
+        self.begin_stale = False
+        self.begin_choices = array('q')
+        self.begin_cumdist = array('q')
+
+        for follow, count in self.begin_counts.items():
+            self.begin_choices.append(follow)
+            self.begin_cumdist.append(self.sentence_count() + count)
+
+    # array rows hold follow ids bit-inverted (~id is negative) so row.index(~follow) can never match a count. rows with
+    # many follows also get a dict of follow positions, so learning doesn't scan them
+    def add_transition(self, key, follow, count):
+        # the begin state packs to 0
+        if key == 0:
+            if follow not in self.begin_counts:
+                self.begin_counts[follow] = 0
+                self.transition_count += 1
+
+            self.begin_counts[follow] += count
+            return
+
+        row = self.rows.get(key)
+
+        if row is None:
+            self.rows[key] = (count << TOKEN_BITS) | follow
+            self.transition_count += 1
+
+            if self.index is not None:
+                self.index_state(key)
+            return
+
+        if type(row) is int:
+            if row & TOKEN_MASK == follow:
+                self.rows[key] = row + (count << TOKEN_BITS)
+                return
+
+            row = self.rows[key] = array('q', (~(row & TOKEN_MASK), row >> TOKEN_BITS))
+
+        positions = self.row_positions.get(key)
+
+        if positions is not None:
+            j = positions.get(follow)
+        elif ~follow in row:
+            j = row.index(~follow)
+        else:
+            j = None
+
+        if j is not None:
+            row[j + 1] += count
+        else:
+            if positions is not None:
+                positions[follow] = len(row)
+            elif len(row) >= 2 * ROW_POSITIONS_MIN:
+                self.row_positions[key] = {~row[i]: i for i in range(0, len(row), 2)}
+                self.row_positions[key][follow] = len(row)
+
+            row.append(~follow)
+            row.append(count)
+            self.transition_count += 1
+
+    # the reverse of add_transition, dropping follows and states whose count reaches 0
+    def remove_transition(self, key, follow, count):
+        if key == 0:
+            self.begin_counts[follow] -= count
+            if self.begin_counts[follow] <= 0:
+                del self.begin_counts[follow]
+                self.transition_count -= 1
+
+            self.begin_stale = True
+            return
+
+        row = self.rows[key]
+
+        if type(row) is int:
+            row -= count << TOKEN_BITS
+
+            if row >> TOKEN_BITS > 0:
+                self.rows[key] = row
+            else:
+                del self.rows[key]
+                self.transition_count -= 1
+
+                if self.index is not None:
+                    self.unindex_state(key)
+            return
+
+        positions = self.row_positions.get(key)
+        j = positions[follow] if positions is not None else row.index(~follow)
+
+        row[j + 1] -= count
+        if row[j + 1] > 0:
+            return
+
+        del row[j:j + 2]
+        self.transition_count -= 1
+
+        if positions is not None:
+            if len(row) < 2 * ROW_POSITIONS_MIN:
+                del self.row_positions[key]
+            else:
+                self.row_positions[key] = {~row[i]: i for i in range(0, len(row), 2)}
+
+        # back to a single follow
+        if len(row) == 2:
+            self.rows[key] = (row[1] << TOKEN_BITS) | ~row[0]
+
+    # the first word that isn't BEGIN sits in the lowest non-zero bits
+    def first_token(self, key):
+        while key & TOKEN_MASK == BEGIN_ID:
+            key >>= TOKEN_BITS
+
+        return key & TOKEN_MASK
+
+    def index_state(self, key):
+        token_id = self.first_token(key)
+
+        if token_id not in self.index:
+            self.index[token_id] = array('q')
+
+        self.index[token_id].append(key)
+
+    def unindex_state(self, key):
+        token_id = self.first_token(key)
+
+        self.index[token_id].remove(key)
+        if not self.index[token_id]:
+            del self.index[token_id]
+
+    # folds a single run (list of words) into the chain in place, in time proportional to the length of the run
+    def learn(self, run, weight=1):
+        # every word is interned first, so a run the vocab can't hold leaves the chain as it was
+        follows = [self.vocab.intern(word) for word in run]
+
+        shift = TOKEN_BITS * (self.state_size - 1)
+        key = 0
+
+        for follow in follows:
+            self.add_transition(key, follow, weight)
+            key = (key >> TOKEN_BITS) | (follow << shift)
+
+        self.add_transition(key, END_ID, weight)
+
+        # a stale cache is rebuilt from the counts, which already have this run
+        if not self.begin_stale:
+            self.begin_choices.append(follows[0] if follows else END_ID)
+            self.begin_cumdist.append(self.sentence_count() + weight)
+
+    # takes a run learned before back out of the chain, in time proportional to the length of the run
+    def unlearn(self, run, weight=1):
+        shift = TOKEN_BITS * (self.state_size - 1)
+        key = 0
+
+        for word in run:
+            follow = self.vocab.token_ids[word]
+            self.remove_transition(key, follow, weight)
+            key = (key >> TOKEN_BITS) | (follow << shift)
+
+        self.remove_transition(key, END_ID, weight)
+
+    def sentence_count(self):
+        if self.begin_stale:
+            self.compile_begin()
+
+        return super().sentence_count()
+
+    def move_id(self, key):
+        if key == 0:
+            if self.begin_stale:
+                self.compile_begin()
+
+            r = random.random() * self.begin_cumdist[-1]
+            return self.begin_choices[bisect.bisect(self.begin_cumdist, r)]
+
+        row = self.rows[key]
+        if type(row) is int:
+            return row & TOKEN_MASK
+
+        cumdist = list(itertools.accumulate(row[1::2]))
+        r = random.random() * cumdist[-1]
+        return ~row[2 * bisect.bisect(cumdist, r)]
+
+    # total weight of the follows of a state, 0 if the chain doesn't have it
+    def row_total(self, key):
+        if key == 0:
+            return self.sentence_count()
+
+        row = self.rows.get(key)
+        if row is None:
+            return 0
+        if type(row) is int:
+            return row >> TOKEN_BITS
+
+        return sum(row[1::2])
+
+    @property
+    def indexed(self):
+        return self.index is not None
+
+    def index_keys(self, token_id):
+        return self.index.get(token_id, ()) if self.index is not None else ()
+
+    def indexed_tokens(self):
+        return sorted(self.index) if self.index is not None else []
+
+    def state_keys(self):
+        return self.rows.keys()
+
+    def row_items(self, key):
+        row = self.rows[key]
+        if type(row) is int:
+            return [(row & TOKEN_MASK, row >> TOKEN_BITS)]
+
+        return [(~row[j], row[j + 1]) for j in range(0, len(row), 2)]
+
+    def begin_items(self):
+        return self.begin_counts.items()
+
+    # number of distinct words that start a run
+    def begin_count(self):
+        return len(self.begin_counts)
+
+    def state_count(self):
+        return len(self.rows) + (1 if self.begin_counts else 0)
+
+    # read-only copy of the chain in flat sorted arrays, for models that are done learning
+    def freeze(self):
+        return FrozenChain(self)
+
+
+# read-only chain stored as flat arrays: sorted state keys, each state's slice of follow ids and cumulative weights,
+# and the word index as sorted word ids with their slice of state keys. lookups bisect the sorted arrays, so there are
+# no per-state python objects. the arrays can be anything indexable, like memoryviews of a mapped snapshot file
+class FrozenChain(BaseChain):
+    frozen = True
+
+    # the arrays that make up the chain, in the order they're written to snapshots
+    arrays = ('keys', 'offsets', 'follows', 'cumdist', 'begin_choices', 'begin_cumdist', 'index_tokens',
+              'index_offsets', 'index_states')
+
+    def __init__(self, source):
+        super().__init__(source.state_size, vocab=source.vocab)
+
+        self.keys = array('q')
+        self.offsets = array('q', [0])
+        self.follows = array('q')
+        self.cumdist = array('q')
+
+        for key, items in source.sorted_rows():
+            self.keys.append(key)
+
+            total = 0
+            for follow, count in items:
+                total += count
+                self.follows.append(follow)
+                self.cumdist.append(total)
+
+            self.offsets.append(len(self.follows))
+
+        self.begin_choices = array('q')
+        self.begin_cumdist = array('q')
+        for follow, count in source.begin_items():
+            self.begin_choices.append(follow)
+            self.begin_cumdist.append(self.sentence_count() + count)
+
+        self.transition_count = source.transition_count
+
+        self.indexed = source.indexed
+        self.index_tokens = array('q')
+        self.index_offsets = array('q', [0])
+        self.index_states = array('q')
+
+        if self.indexed:
+            for token_id in source.indexed_tokens():
+                self.index_tokens.append(token_id)
+                # an overlay chain can list a state twice, when both of its chains have it
+                self.index_states.extend(dict.fromkeys(source.index_keys(token_id)))
+                self.index_offsets.append(len(self.index_states))
+
+    # rebuilds a chain from its arrays, without copying them
+    @classmethod
+    def from_arrays(cls, state_size, vocab, arrays, transition_count, indexed):
+        chain = cls.__new__(cls)
+        BaseChain.__init__(chain, state_size, vocab=vocab)
+
+        for name in cls.arrays:
+            setattr(chain, name, arrays[name])
+
+        chain.transition_count = transition_count
+        chain.indexed = indexed
+        return chain
+
+    def row_range(self, key):
+        i = bisect.bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            raise KeyError(key)
+
+        return self.offsets[i], self.offsets[i + 1]
+
+    def move_id(self, key):
+        if key == 0:
+            r = random.random() * self.begin_cumdist[-1]
+            return self.begin_choices[bisect.bisect(self.begin_cumdist, r)]
+
+        lo, hi = self.row_range(key)
+        r = random.random() * self.cumdist[hi - 1]
+        return self.follows[bisect.bisect(self.cumdist, r, lo, hi)]
+
+    def row_total(self, key):
+        if key == 0:
+            return self.sentence_count()
+
+        i = bisect.bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            return 0
+
+        return self.cumdist[self.offsets[i + 1] - 1]
+
+    def index_keys(self, token_id):
+        i = bisect.bisect_left(self.index_tokens, token_id)
+        if i == len(self.index_tokens) or self.index_tokens[i] != token_id:
+            return ()
+
+        return self.index_states[self.index_offsets[i]:self.index_offsets[i + 1]]
+
+    def indexed_tokens(self):
+        return self.index_tokens
+
+    def state_keys(self):
+        return self.keys
+
+    def row_items(self, key):
+        lo, hi = self.row_range(key)
+        return [(self.follows[j], self.cumdist[j] - (self.cumdist[j - 1] if j > lo else 0)) for j in range(lo, hi)]
+
+    def begin_items(self):
+        return [(self.begin_choices[j], self.begin_cumdist[j] - (self.begin_cumdist[j - 1] if j > 0 else 0))
+                for j in range(len(self.begin_choices))]
+
+    # the keys are already sorted, so rows are read in order without searching for them
+    def sorted_rows(self):
+        for i, key in enumerate(self.keys):
+            lo, hi = self.offsets[i], self.offsets[i + 1]
+            yield key, [(self.follows[j], self.cumdist[j] - (self.cumdist[j - 1] if j > lo else 0))
+                        for j in range(lo, hi)]
+
+    def begin_count(self):
+        return len(self.begin_choices)
+
+    def state_count(self):
+        return len(self.keys) + (1 if self.begin_choices else 0)
+
+    # learnable copy of the chain
+    def thaw(self):
+        chain = Chain(None, self.state_size, indexed=self.indexed, vocab=self.vocab)
+
+        for follow, count in self.begin_items():
+            chain.add_transition(0, follow, count)
+
+        for key in self.keys:
+            for follow, count in self.row_items(key):
+                chain.add_transition(key, follow, count)
+
+        chain.compile_begin()
+        return chain
+
+
+# a shared read-only chain with a small learnable chain on top, over an overlay vocab of the base's (or vocab, an
+# overlay vocab shared with the reverse chain). sampling a state picks the base or the overlay in proportion to their
+# weight for it, which is the same as sampling from the two chains added together. statistics add the two chains'
+# numbers, so anything learned by both is counted twice
+class OverlayChain(BaseChain):
+
+    def __init__(self, base, vocab=None):
+        super().__init__(base.state_size, vocab=vocab or OverlayVocab(base.vocab))
+
+        self.base = base
+        self.overlay = Chain(None, base.state_size, indexed=base.indexed, vocab=self.vocab)
+
+    @property
+    def indexed(self):
+        return self.base.indexed
+
+    @property
+    def transition_count(self):
+        return self.base.transition_count + self.overlay.transition_count
+
+    def learn(self, run, weight=1):
+        self.overlay.learn(run, weight=weight)
+
+    def unlearn(self, run, weight=1):
+        self.overlay.unlearn(run, weight=weight)
+
+    def move_id(self, key):
+        base_total = self.base.row_total(key)
+        overlay_total = self.overlay.row_total(key)
+
+        if random.random() * (base_total + overlay_total) < base_total:
+            return self.base.move_id(key)
+
+        return self.overlay.move_id(key)
+
+    def index_keys(self, token_id):
+        return list(self.base.index_keys(token_id)) + list(self.overlay.index_keys(token_id))
+
+    # knows and states_with look in each chain, rather than joining their states with index_keys first
+    def knows(self, word):
+        token_id = self.vocab.token_ids.get(word)
+        return (token_id is not None) \
+            and ((len(self.base.index_keys(token_id)) > 0) or (len(self.overlay.index_keys(token_id)) > 0))
+
+    def states_with(self, word):
+        return self.base.states_with(word) + self.overlay.states_with(word)
+
+    def indexed_tokens(self):
+        return sorted(set(self.base.indexed_tokens()) | set(self.overlay.indexed_tokens()))
+
+    def random_state_with(self, word):
+        token_id = self.vocab.token_ids.get(word)
+        if token_id is None:
+            return None
+
+        base_keys = self.base.index_keys(token_id)
+        overlay_keys = self.overlay.index_keys(token_id)
+        if len(base_keys) + len(overlay_keys) == 0:
+            return None
+
+        i = random.randrange(len(base_keys) + len(overlay_keys))
+        return self.unpack(base_keys[i] if i < len(base_keys) else overlay_keys[i - len(base_keys)])
+
+    def sentence_count(self):
+        return self.base.sentence_count() + self.overlay.sentence_count()
+
+    def begin_count(self):
+        return self.base.begin_count() + self.overlay.begin_count()
+
+    def state_count(self):
+        return self.base.state_count() + self.overlay.state_count()
+
+    def state_keys(self):
+        return set(self.base.state_keys()) | set(self.overlay.state_keys())
+
+    def merge_items(self, base_items, overlay_items):
+        merged = dict(base_items)
+        for follow, count in overlay_items:
+            merged[follow] = merged.get(follow, 0) + count
+
+        return merged.items()
+
+    def row_items(self, key):
+        base_items = self.base.row_items(key) if self.base.row_total(key) else []
+        overlay_items = self.overlay.row_items(key) if self.overlay.row_total(key) else []
+
+        return self.merge_items(base_items, overlay_items)
+
+    def begin_items(self):
+        return self.merge_items(self.base.begin_items(), self.overlay.begin_items())
+
+    # merges the overlay's few rows into the base's rows as they go by
+    def sorted_rows(self):
+        overlay_keys = sorted(self.overlay.state_keys())
+        j = 0
+
+        for key, items in self.base.sorted_rows():
+            while j < len(overlay_keys) and overlay_keys[j] < key:
+                yield overlay_keys[j], self.overlay.row_items(overlay_keys[j])
+                j += 1
+
+            if j < len(overlay_keys) and overlay_keys[j] == key:
+                items = self.merge_items(items, self.overlay.row_items(key))
+                j += 1
+
+            yield key, items
+
+        for key in overlay_keys[j:]:
+            yield key, self.overlay.row_items(key)
+
+    # read-only copy of both chains added together. with nothing learned, that's just the base
+    def freeze(self):
+        return self.base if self.overlay.transition_count == 0 else FrozenChain(self)
@@ -3,6 +3,8 @@ import re
 from discord.ext import commands
 
 import format
+import history
+import metrics
 
 
 def can_ban():
@@ -21,9 +23,16 @@ def can_ban():
 
 
 class Commands(commands.Cog, name='Commands'):
-    def __init__(self, client, bots):
+    def __init__(self, client, bots, store=None):
         self.client = client
         self.bots = bots
+        self.store = store
+
+    # saves the guild's settings after every command, in case it changed them
+    async def cog_after_invoke(self, ctx):
+        if (self.store is not None) and (ctx.guild is not None) and (ctx.guild.id in self.bots):
+            self.store.save(ctx.guild.id, self.bots[ctx.guild.id].get_settings())
+            self.store.schedule_flush()
 
     @commands.command(
         name='set_channel',
@@ -52,7 +61,7 @@ class Commands(commands.Cog, name='Commands'):
     async def take(self, ctx):
         if self.bots[ctx.guild.id].channel_id != '':
             async with ctx.typing():
-                await ctx.send(self.bots[ctx.guild.id].generate_take(message=None))
+                await ctx.send(await self.bots[ctx.guild.id].generate_take_async(message=None))
         else:
             await ctx.send('Must set an active channel first')
 
@@ -70,9 +79,9 @@ class Commands(commands.Cog, name='Commands'):
         if self.bots[ctx.guild.id].channel_id != '':
             async with ctx.typing():
                 if arg is not None:
-                    rant = self.bots[ctx.guild.id].generate_rant(rant_size=int(arg))
+                    rant = await self.bots[ctx.guild.id].generate_rant_async(rant_size=int(arg))
                 else:
-                    rant = self.bots[ctx.guild.id].generate_rant()
+                    rant = await self.bots[ctx.guild.id].generate_rant_async()
 
                 await ctx.send(rant)
         else:
@@ -118,7 +127,7 @@ class Commands(commands.Cog, name='Commands'):
     @can_ban()
     async def reset(self, ctx):
         await ctx.guild.get_member(self.client.user.id).edit(nick=None)
-        self.bots[ctx.guild.id].reset()
+        await self.bots[ctx.guild.id].reset_async()
         await ctx.send('Model reset.')
 
     @reset.error
@@ -127,15 +136,17 @@ class Commands(commands.Cog, name='Commands'):
 
     @commands.command(
         name='save',
-        help='Saves the bot\'s model to json file. Name can be specified, otherwise it overwrites "default"',
+        help='Saves the bot\'s model to a snapshot file. Name can be specified, otherwise it overwrites "default". '
+             'Add `json` to export it as markovify json instead, i.e. `$save default json`',
         brief='Saves the bot\'s model to specified file'
     )
     @can_ban()
-    async def save(self, ctx, arg=None):
+    async def save(self, ctx, arg=None, fmt='snapshot'):
         if arg is None:
             arg = 'default'
 
-        if self.bots[ctx.guild.id].model.save_model(model_name=arg) is not None:
+        bot = self.bots[ctx.guild.id]
+        if await bot.run_serialized(bot.save_model, model_name=arg, fmt=fmt) is not None:
             await ctx.send(f'Model \"{arg}\" saved.')
         else:
             await ctx.send('Failed to save model.')
@@ -157,9 +168,7 @@ class Commands(commands.Cog, name='Commands'):
         if arg is None:
             arg = 'default'
 
-        bot.reset()
-        bot.current_data_set = arg
-        if bot.model.load_model(model_name=arg) is not None:
+        if await bot.load_async(model_name=arg) is not None:
             await ctx.send(f'Model \"{arg}\" loaded.')
         else:
             await ctx.send('Failed to load model.')
@@ -170,18 +179,24 @@ class Commands(commands.Cog, name='Commands'):
 
     @commands.command(
         name='train',
-        help='Resets the bot\'s model, then trains on the specified data set',
+        help='Resets the bot\'s model, then trains on the specified data set. Files can be weighted by adding '
+             '`file=weight` pairs, i.e. `$train prophet Mayhem7115.txt=3`',
         brief='Trains on the specified data set'
     )
     @can_ban()
-    async def train(self, ctx, arg):
+    async def train(self, ctx, arg, *args):
         if self.bots[ctx.guild.id].current_data_set == arg:
             await ctx.send(f'Already trained on {arg}')
         else:
             try:
+                weights = {}
+                for pair in args:
+                    f, weight = pair.rsplit('=', 1)
+                    weights[f] = int(weight)
+
                 await ctx.guild.get_member(self.client.user.id).edit(nick=None)
                 await ctx.send(f'Training on {arg} set')
-                self.bots[ctx.guild.id].train_on_files(arg)
+                await self.bots[ctx.guild.id].train_on_files_async(arg, weights=weights)
                 await ctx.send(f'Trained on {arg} set')
             except FileNotFoundError:
                 await ctx.send(f'Dataset {arg} not found')
@@ -309,6 +324,67 @@ class Commands(commands.Cog, name='Commands'):
     async def learn_error(self, ctx, error):
         return
 
+    @commands.command(
+        name='learn_limit',
+        help='Sets how many of the most recently learned sentences the bot keeps, forgetting older ones as it learns '
+             'new ones, or `off` to keep everything, i.e. `$learn_limit 10000`',
+        brief='Sets how many learned sentences the bot keeps'
+    )
+    @can_ban()
+    async def learn_limit(self, ctx, arg):
+        bot = self.bots[ctx.guild.id]
+        await bot.run_serialized(bot.set_learn_limit, None if arg == 'off' else int(arg))
+        await ctx.send(f'Learn limit set to {bot.learn_limit}')
+
+    @learn_limit.error
+    async def learn_limit_error(self, ctx, error):
+        return
+
+    @commands.command(
+        name='seed_window',
+        help='Sets how many recent messages the bot picks seed words for takes and gifs from, favoring the words used '
+             'most, i.e. `$seed_window 20`',
+        brief='Sets how many recent messages takes are seeded from'
+    )
+    @can_ban()
+    async def seed_window(self, ctx, arg):
+        bot = self.bots[ctx.guild.id]
+        await bot.run_serialized(bot.seed_index.resize, max(1, int(arg)))
+
+        await ctx.send(f'Seed window set to {bot.seed_index.size} messages')
+
+    @seed_window.error
+    async def seed_window_error(self, ctx, error):
+        return
+
+    @commands.command(
+        name='stopwords',
+        help='Adds or removes words this server never seeds takes, replies or gifs with, or rereads the word lists '
+             'from their files, i.e. `$stopwords add lol lmao`, `$stopwords remove lol` or `$stopwords reload`. '
+             'Lists the server\'s words if given nothing',
+        brief='Changes the words takes are never seeded with'
+    )
+    @can_ban()
+    async def stopwords(self, ctx, action=None, *words):
+        bot = self.bots[ctx.guild.id]
+        words = {word.lower() for word in words}
+
+        if action == 'add':
+            bot.save_stopwords(bot.custom_stopwords | words)
+        elif action == 'remove':
+            bot.save_stopwords(bot.custom_stopwords - words)
+        elif action == 'reload':
+            format.reload_stopwords()
+            for guild_bot in self.bots.values():
+                guild_bot.load_stopwords()
+
+        custom = ', '.join(sorted(bot.custom_stopwords)) or 'none'
+        await ctx.send(f'Server stopwords: {custom} (plus {len(format.boring_words)} defaults)')
+
+    @stopwords.error
+    async def stopwords_error(self, ctx, error):
+        return
+
     @commands.command(
         name='lock_only',
         help='Toggles the bot\'s ability to train on messages from users with Vending Machine or Vanilla Warrior roles',
@@ -355,47 +431,127 @@ class Commands(commands.Cog, name='Commands'):
         brief='Gives the status of the bot\'s internal parameters'
     )
     async def status(self, ctx):
-        channel = self.client.get_channel(self.bots[ctx.guild.id].channel_id)
+        bot = self.bots[ctx.guild.id]
+        channel = self.client.get_channel(bot.channel_id)
+        # read under the guild's lock, so a restored bot reports its restored model
+        bot_status = await bot.run_serialized(bot.status, ctx.author)
 
         if channel is not None:
-            status_text = f'LGX STATUS\n\n**Active channel**: {channel.mention}\n' + self.bots[ctx.guild.id].status(ctx.author)
+            status_text = f'LGX STATUS\n\n**Active channel**: {channel.mention}\n' + bot_status
         else:
-            status_text = f'LGX STATUS\n\n**Active channel**: none\n' + self.bots[ctx.guild.id].status(ctx.author)
+            status_text = f'LGX STATUS\n\n**Active channel**: none\n' + bot_status
         await ctx.reply(status_text)
 
     @status.error
     async def status_error(self, ctx, error):
         return
 
+    @commands.command(
+        name='readiness',
+        help='Samples takes from the current model to check whether it can produce unique takes, and shows the chain '
+             'statistics used to decide readiness while learning',
+        brief='Checks whether the model can produce unique takes'
+    )
+    @can_ban()
+    async def readiness(self, ctx, arg=None):
+        bot = self.bots[ctx.guild.id]
+        test_size = 15 if arg is None else int(arg)
+
+        unique = await bot.run_serialized(bot.test_take_readiness, test_size=test_size)
+        c = bot.model.generator.chain
+
+        await ctx.send(f'{test_size} sampled takes unique: {unique}\n'
+                       f'Ready: {bot.can_generate_unique_takes}\n'
+                       f'Sentences: {c.sentence_count()} (min {bot.model.min_ready_sentences})\n'
+                       f'Begin words: {c.begin_count()} (min {bot.model.min_ready_begins})\n'
+                       f'Branching factor: {c.branching_factor():.3f} (min {bot.model.min_ready_branching})\n'
+                       f'Tries per sentence: {bot.model.tries_per_sentence():.2f}')
+
+    @readiness.error
+    async def readiness_error(self, ctx, error):
+        return
+
+    @commands.command(
+        name='perf',
+        help='Shows how long each stage of handling messages has taken, overall and in this server, and the servers '
+             'slowest to make takes. `on` and `off` start and stop timing, and `reset` clears the timings',
+        brief='Shows how long the bot takes to respond'
+    )
+    @can_ban()
+    async def perf(self, ctx, arg=None):
+        if arg == 'on':
+            metrics.enabled = True
+        elif arg == 'off':
+            metrics.enabled = False
+        elif arg == 'reset':
+            metrics.reset()
+
+        def ms(seconds):
+            return f'{seconds * 1000:.1f}'
+
+        lines = [f'{"stage":<14}{"count":>7}{"mean":>8}{"p50":>8}{"p95":>8}{"p99":>8}{"max":>8}']
+        for stage, n, mean, p50, p95, p99, slowest in metrics.summary():
+            lines.append(f'{stage:<14}{n:>7}{ms(mean):>8}{ms(p50):>8}{ms(p95):>8}{ms(p99):>8}{ms(slowest):>8}')
+
+        lines += ['', 'this server']
+        for stage, n, mean, slowest in metrics.guild_summary(ctx.guild.id):
+            lines.append(f'{stage:<14}{n:>7}{ms(mean):>8}{"":>24}{ms(slowest):>8}')
+
+        lines += ['', 'slowest servers (take)']
+        for guild_id, n, mean, slowest in metrics.slowest_guilds('take'):
+            lines.append(f'{guild_id:<22}{n:>7}{ms(mean):>8}{ms(slowest):>8}')
+
+        table = '\n'.join(lines)[:1800]
+        await ctx.send(f'Timing: {"on" if metrics.enabled else "off"} (ms)\n'
+                       f'Tries per sentence: {self.bots[ctx.guild.id].model.tries_per_sentence():.2f}\n'
+                       f'```\n{table}\n```')
+
+    @perf.error
+    async def perf_error(self, ctx, error):
+        return
+
 
     @commands.command(
         name='sim',
-        help='Simulates the specified user. Must use their tag/mention',
+        help='Simulates the specified user. Must use their tag/mention. Several users can be given to simulate them '
+             'all at once',
         brief='Simulates the specified user'
     )
     @can_ban()
-    async def sim(self, ctx, arg):
+    async def sim(self, ctx, *args):
+        if len(args) == 0:
+            return
+
         await ctx.guild.get_member(self.client.user.id).edit(nick=None)
-        self.bots[ctx.guild.id].reset()
+        await self.bots[ctx.guild.id].reset_async()
 
         channel = ctx.channel
 
-        user_id = int(re.sub('[^0-9]', '', arg))
-        user = ctx.guild.get_member(user_id)
-        usertag = f'{user.name}#{user.discriminator}'
+        users = [ctx.guild.get_member(int(re.sub('[^0-9]', '', arg))) for arg in args]
+        usertags = [f'{user.name}#{user.discriminator}' for user in users]
         full_path = f'{self.bots[ctx.guild.id].training_root_dir}/users/'
 
-        if f'{usertag}.txt' not in os.listdir(full_path):
-            await channel.send(f'Collecting data for {usertag}')
-            hist = [msg.content for msg in await channel.history(limit=99999).flatten() if msg.author.id == user_id]
-            format.write_history(hist, root_dir=f'{self.bots[ctx.guild.id].training_root_dir}/users/',
-                                 file_name=usertag)
-        else:
-            await channel.send(f'Found existing data for {usertag}')
+        # users are all collected in one pass over the channel's history. users with data only get the messages
+        # posted since it was last collected from this channel
+        user_files = {user.id: f'{full_path}{usertag}.txt' for user, usertag in zip(users, usertags)}
+        after = {user_id: history.last_message_id(path, channel.id) for user_id, path in user_files.items()}
+
+        collecting = ', '.join(usertags)
+        verb = 'Updating' if None not in after.values() else 'Collecting'
+        status = await channel.send(f'{verb} data for {collecting}')
+
+        async def progress(scanned, counts):
+            await status.edit(content=f'{verb} data for {collecting}: {scanned} messages scanned, '
+                                      f'{sum(counts.values())} found')
 
-        self.bots[ctx.guild.id].train_on_files(train_dir='users', file=f'{usertag}.txt')
-        await channel.send(f'Now simulating {usertag}')
-        await ctx.guild.get_member(self.client.user.id).edit(nick=f'{user.name}bot')
+        counts = await history.collect_history(channel, user_files, after=after, progress=progress)
+        found = ', '.join(f'{counts[user.id]} new for {usertag}' for user, usertag in zip(users, usertags))
+        await status.edit(content=f'{verb} data for {collecting}: {found}')
+
+        await self.bots[ctx.guild.id].train_on_files_async(train_dir='users',
+                                                           file=[f'{usertag}.txt' for usertag in usertags])
+        await channel.send(f'Now simulating {", ".join(usertags)}')
+        await ctx.guild.get_member(self.client.user.id).edit(nick=f'{"".join(user.name for user in users)[:29]}bot')
 
     @sim.error
     async def sim_error(self, ctx, error):
@@ -440,7 +596,8 @@ class Commands(commands.Cog, name='Commands'):
     @can_ban()
     async def models(self, ctx):
         model_dir = self.bots[ctx.guild.id].model.root_dir
-        await ctx.send(f'Saved models: {[f.split(".")[0] for f in os.listdir(model_dir) if f.endswith(".json")]}')
+        models = sorted({f.split(".")[0] for f in os.listdir(model_dir) if f.endswith((".json", ".lgx"))})
+        await ctx.send(f'Saved models: {models}')
 
     @models.error
     async def models_error(self, ctx, error):
@@ -458,4 +615,30 @@ class Commands(commands.Cog, name='Commands'):
 
     @gif_chance.error
     async def gif_chance_error(self, ctx, error):
+        return
+
+    @commands.command(
+        name='take_window',
+        help='Sets how many recent takes are remembered so they aren\'t posted again. Optionally also sets the % of a '
+             'take\'s phrases that have to match a remembered take for it to count as a repeat, or `off` to only skip '
+             'exact repeats, i.e. `$take_window 500 80`',
+        brief='Sets how many recent takes are remembered'
+    )
+    @can_ban()
+    async def take_window(self, ctx, arg, ratio=None):
+        previous_takes = self.bots[ctx.guild.id].previous_takes
+        # takes are checked against the window in the worker pool, so it's resized under the guild's lock
+        await self.bots[ctx.guild.id].run_serialized(previous_takes.resize, int(arg))
+
+        if ratio == 'off':
+            previous_takes.near_duplicate_ratio = None
+        elif ratio is not None:
+            previous_takes.near_duplicate_ratio = float(ratio) / 100
+
+        near_duplicates = 'off' if previous_takes.near_duplicate_ratio is None \
+            else f'{previous_takes.near_duplicate_ratio * 100:g}%'
+        await ctx.send(f'Remembering the last {previous_takes.size} takes (near-duplicates: {near_duplicates})')
+
+    @take_window.error
+    async def take_window_error(self, ctx, error):
         return
\ No newline at end of file
@@ -3,23 +3,36 @@ import os
 import random
 import re
 
+special_chars = ['â', '€', '™', '‰', 'ð', 'Ÿ', '¤', '¡', 'š', '~', '˜', 'Γ', 'Ç', 'Ö', 'ª',
+                 '¥', '£', '≡', 'ƒ', 'Æ', '¬', 'Å', '┐', 'é', 'Ñ', 'ö', 'ÿ', '¢', '┬', '»', 'π',
+                 'ä', 'ñ', 'í', '⠀']
+
+url_pattern = r'https?://.*[\r\n]*'
+# a mention stops where a url starts, so the url is removed to the end of its line like it would be on its own
+mention_pattern = r'@(?:(?!https?://)\S)+'
+special_pattern = f'[{"".join(special_chars)}]'
+
+url_reg = re.compile(url_pattern)
+mention_reg = re.compile(r'@\S+')
+special_reg = re.compile(special_pattern)
+
+# urls, mentions and special characters removed in a single pass. only used on text that has a url or mention in it,
+# as the alternation is slower than the character class alone
+clean_reg = re.compile(f'{url_pattern}|{mention_pattern}|{special_pattern}')
+
 
 def remove_url(text):
-    return re.sub("https?:\/\/.*[\r\n]*", "", text)
+    return url_reg.sub('', text)
 
 
 def remove_mentions(text):
-    text = re.sub("@\S+", "", text)
-    return re.sub("<@\S+", "", text)
+    return mention_reg.sub('', text)
 
 
 def remove_special(text):
-    chars = ['â', '€', '™', '‰', 'ð', 'Ÿ', '¤', '¡', 'š', '~', '˜', 'Γ', 'Ç', 'Ö', 'ª',
-             '¥', '£', '≡', 'ƒ', 'Æ', '¬', 'Å', '┐', 'é', 'Ñ', 'ö', 'ÿ', '¢', '┬', '»', 'π',
-             'ä', 'ñ', 'í', '⠀']
-
-    for char in chars:
-        text = text.replace(char, '')
+    # '~' is the only special character in ascii
+    if (not text.isascii()) or ('~' in text):
+        text = special_reg.sub('', text)
 
     return text.replace('\n', '.')
 
@@ -35,7 +48,7 @@ def strip_question(text):
 
 def strip_period(text):
     # strip the ending period
-    if random.randrange(0, 100) > 20:
+    if random.random() < 0.79:
         if text[-1] == '.':
             text = text[:-1]
 
@@ -52,9 +65,11 @@ def add_period_if_needed(text):
 
 def text_cleaner(text, remove_periods=True):
     try:
-        text = remove_url(text)
-        text = remove_mentions(text)
-        text = remove_special(text)
+        if ('@' in text) or ('http' in text):
+            text = clean_reg.sub('', text).replace('\n', '.')
+        else:
+            text = remove_special(text)
+
         text = strip_question(text)
 
         if remove_periods:
@@ -67,6 +82,16 @@ def text_cleaner(text, remove_periods=True):
     return text
 
 
+# cleans a list or stream of lines, yielding the ones that aren't empty before or after cleaning
+def clean_lines(lines, remove_periods=True):
+    for line in lines:
+        if line and not line.isspace():
+            clean_line = text_cleaner(line, remove_periods=remove_periods)
+
+            if clean_line != '':
+                yield clean_line
+
+
 def add_suffix(text):
     leads = ['...', 'ok', 'okay', 'w/e', 'smh']
     laughs = ['LOL', 'lul', 'KEKW', 'hahaha', 'lmao', 'lmfao', 'XD', 'xD', 'xd', 'Xd']
@@ -117,27 +142,38 @@ def remove_all_punctuation(text):
     return text
 
 
-# removes mentions and "boring" words from query text to result in a better response from the bot
-def remove_boring_words(query_text):
-    boring = ['who', 'what', 'when', 'where', 'why', 'you', 'me', 'he', 'she', 'it', 'do', 'will', 'did', 'can', 'with',
-              'is', 'am', 'if', 'was', 'are', 'i', 'should', 'would', 'does', 'this', 'oh', 'um', 'huh', 'heh', 'as',
-              'a', 'an', 'or', 'be', 'on', 'in', 'for', 'thoughts', 'and', 'your', 'u', 'ur', 'about', 'to', 'my',
-              'mine', 'too', 'about', 'at', 'arent', 'there', 'their', 'opinion', 'not', 'that', 'i', 'how', 'so', 'of',
-              'them', 'but', 'than', 'much', 'yet', 'unto', 'have', 'us', 'the']
+punctuation_reg = re.compile(r'[!,.?;:\'"()]')
+
+stopwords_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'filter.txt')
+
+
+# a stopword file has one word per line. blank lines and lines starting with # are skipped, and a missing file has no
+# words in it
+def load_stopwords(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return frozenset(line.strip().lower() for line in f if line.strip() and not line.startswith('#'))
+    except:
+        return frozenset()
+
+
+boring_words = load_stopwords(stopwords_path)
+
+
+# rereads filter.txt, for changing the boring words without a restart
+def reload_stopwords():
+    global boring_words
 
-    query_text = query_text.split(' ')
-    query_text = [word for word in query_text if str.lower(word) not in boring]
-    query_text = [remove_all_punctuation(word) for word in query_text if not word.startswith('<')]
+    boring_words = load_stopwords(stopwords_path)
+    return boring_words
 
-    return query_text
 
+# removes mentions, punctuation and "boring" words from query text to result in a better response from the bot.
+# stopwords replaces the words in filter.txt, e.g. with a guild's own list
+def remove_boring_words(query_text, stopwords=None):
+    if stopwords is None:
+        stopwords = boring_words
 
-def write_history(hist, root_dir, file_name):
-    if f'{file_name}.txt' not in os.listdir(root_dir):
-        with open(f'{root_dir}/{file_name}.txt', 'w', encoding='iso-8859-1') as f:
-            for line in hist:
-                try:
-                    f.write(f'{text_cleaner(line)}\n')
-                except:
-                    pass
+    return [word for word in punctuation_reg.sub('', query_text).split()
+            if (not word.startswith('<')) and (word.lower() not in stopwords)]
 
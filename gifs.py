@@ -0,0 +1,117 @@
+import aiohttp
+import asyncio
+import collections
+import sys
+import time
+from aiohttp import web
+
+import metrics
+
+# tenor gif search, shared by every guild. requests go through one pooled session with a timeout, and results are
+# cached by their normalized search words for cache_ttl seconds, dropping the least recently used past cache_size.
+# base_url can point at a local stub server (python gifs.py stub) instead of tenor
+base_url = 'https://g.tenor.com/v1'
+timeout = 5
+max_connections = 10
+cache_size = 512
+cache_ttl = 3600
+
+session = None
+cache = collections.OrderedDict()
+pending = {}
+
+
+def configure(url=None, request_timeout=5, connections=10, size=512, ttl=3600):
+    global base_url, timeout, max_connections, cache_size, cache_ttl
+
+    base_url = url or 'https://g.tenor.com/v1'
+    timeout = request_timeout
+    max_connections = connections
+    cache_size = size
+    cache_ttl = ttl
+    cache.clear()
+
+
+# the session has to be made on the running event loop, so it's made on the first search
+def get_session():
+    global session
+
+    if (session is None) or session.closed:
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=max_connections),
+                                        timeout=aiohttp.ClientTimeout(total=timeout))
+
+    return session
+
+
+def normalize(words):
+    return tuple(sorted({word.lower() for word in words if word}))
+
+
+# gif urls found for the search words, from the cache if they were searched recently. searches for the same words
+# that are already in flight are waited on instead of repeated. failed searches return no urls and aren't cached
+async def search(words, token, limit=8):
+    key = normalize(words)
+
+    entry = cache.get(key)
+    if (entry is not None) and (entry[0] > time.monotonic()):
+        cache.move_to_end(key)
+        metrics.count('gif_cache_hits')
+        return entry[1]
+
+    if key in pending:
+        return await asyncio.shield(pending[key])
+
+    pending[key] = asyncio.ensure_future(fetch(key, token, limit))
+    try:
+        return await asyncio.shield(pending[key])
+    finally:
+        del pending[key]
+
+
+async def fetch(key, token, limit):
+    metrics.count('gif_fetches')
+
+    try:
+        async with get_session().get(f'{base_url}/search',
+                                     params={'q': ' '.join(key), 'key': token, 'limit': limit}) as r:
+            if r.status != 200:
+                metrics.count('gif_errors')
+                return []
+
+            results = await r.json(content_type=None)
+            urls = [result['media'][0]['gif']['url'] for result in results['results']]
+    except:
+        metrics.count('gif_errors')
+        return []
+
+    cache[key] = (time.monotonic() + cache_ttl, urls)
+    cache.move_to_end(key)
+    while len(cache) > cache_size:
+        cache.popitem(last=False)
+
+    return urls
+
+
+async def close():
+    if session is not None:
+        await session.close()
+
+
+# answers searches like tenor's v1 api with made up urls, for testing without a tenor token or network
+async def stub_search(request):
+    words = request.query.get('q', '').replace(' ', '-') or 'none'
+    limit = int(request.query.get('limit', 8))
+
+    return web.json_response(
+        {'results': [{'media': [{'gif': {'url': f'https://stub.gif/{words}/{i}.gif'}}]} for i in range(limit)]})
+
+
+def run_stub(port=8787):
+    app = web.Application()
+    app.router.add_get('/v1/search', stub_search)
+    web.run_app(app, port=port)
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 1) and (sys.argv[1] == 'stub'):
+        run_stub(port=int(sys.argv[2]) if len(sys.argv) > 2 else 8787)
@@ -0,0 +1,103 @@
+import random
+import time
+
+import metrics
+
+
+# decides how the bot responds to a message: learning from it, replying to mentions and posting at random. it only
+# needs client.user (the bot's own user) and client.process_commands from discord, so loadtest.py can drive it with a
+# fake client and fake messages
+class MessageHandler:
+
+    def __init__(self, client, bots, cmd_prefix='$', tenor_token=None,
+                 restricted_roles=('Vending Machine', 'Vanilla Warrior')):
+        self.client = client
+        self.bots = bots
+        self.cmd_prefix = cmd_prefix
+        self.tenor_token = tenor_token
+        self.restricted_roles = restricted_roles
+
+    async def handle(self, message):
+        with metrics.timer('message', message.guild.id):
+            await self.respond(message)
+
+    async def respond(self, message):
+        guild_id = message.guild.id
+
+        # only commands and messages in the bot's channel need the guild's bot to be loaded
+        if (not self.bots.relevant(guild_id, message.channel.id)) and (not message.content.startswith(self.cmd_prefix)):
+            return
+
+        bot = self.bots[guild_id]
+
+        # do not respond to own messages or messages from unpermitted roles
+        if (message.author == self.client.user) \
+                or (bot.restricted and not self.is_permitted(message.author)):
+            return
+        # respond to commands
+        elif message.content.startswith(self.cmd_prefix):
+            await self.client.process_commands(message)
+            return
+
+        # if the message was posted in the bot's set channel, log it -- otherwise ignore it
+        if message.channel.id == bot.channel_id:
+            # if bot is set to warlocks only and the message is sent from a non-warlock, do not train. else train
+            if bot.restricted & (not self.is_permitted(message.author)):
+                return
+            else:
+                bot.msgs_waited += 1 # increment the anti-spam message counter
+                await bot.train(message)
+        else:
+            return
+
+        # respond to mentions if ready
+        if self.client.user in message.mentions:
+            # check if there is an outstanding cooldown for the user
+            if message.author.id in bot.user_mention_times.keys():
+                # check if the cooldown time has elapsed
+                if cooldown_check(bot.user_mention_times[message.author.id], bot.mention_wait):
+                    async with message.channel.typing():
+                        if (random.random()*100 <= bot.gif_chance) & (self.tenor_token is not None) & bot.gifs_enabled:
+                            output = await bot.generate_gif(seed=message.content)
+                        else:
+                            output = await bot.generate_take_async(message=message)
+
+                        await message.reply(output)
+                # do not reply if user is on cooldown
+                else:
+                    return
+            else:
+                async with message.channel.typing():
+                    take = await bot.generate_take_async(message=message)
+                    await message.reply(take)
+
+            bot.start_reply_cd(message.author)
+
+            return
+
+        # post randomly if ready
+        if cooldown_check(bot.time_of_random, bot.random_wait) and (bot.msgs_waited >= bot.msgs_wait):
+            async with message.channel.typing():
+                bot.time_of_random = time.time()
+
+                roll = random.random() * 100
+                if (roll <= bot.gif_chance) & (self.tenor_token is not None) & bot.gifs_enabled:
+                    output = await bot.generate_gif()
+                elif roll <= bot.gif_chance + bot.rant_chance:
+                    output = await bot.generate_rant_async()
+                else:
+                    output = await bot.generate_take_async()
+
+                bot.msgs_waited = 0 # reset the anti-spam message counter to 0
+                if output is not None:
+                    await message.channel.send(output)
+                else:
+                    pass
+
+    def is_permitted(self, author):
+        roles = author.roles
+        return not any(role.name in self.restricted_roles for role in roles)
+
+
+def cooldown_check(time_of_cooldown, cooldown_length):
+    return (time.time() - time_of_cooldown) > cooldown_length*60
@@ -0,0 +1,118 @@
+import datetime
+import json
+import os
+
+import format
+
+# discord ids are snowflakes: milliseconds since the discord epoch, shifted left 22 bits
+DISCORD_EPOCH = 1420070400000
+
+
+def snowflake_time(message_id):
+    return datetime.datetime.fromtimestamp(((message_id >> 22) + DISCORD_EPOCH) / 1000, tz=datetime.timezone.utc)
+
+
+def time_snowflake(timestamp):
+    return (int(timestamp * 1000) - DISCORD_EPOCH) << 22
+
+
+# each user file keeps the id of the newest message scanned in each channel in a json file next to it
+def last_ids_path(path):
+    return f'{os.path.splitext(path)[0]}.json'
+
+
+# the id of the newest message already collected into the user file at path from a channel, or None if nothing was
+# collected from it yet. files collected before ids were kept have no json file, and use their modification time
+def last_message_id(path, channel_id):
+    if not os.path.isfile(path):
+        return None
+
+    if not os.path.isfile(last_ids_path(path)):
+        return time_snowflake(os.path.getmtime(path))
+
+    try:
+        with open(last_ids_path(path)) as f:
+            last_ids = json.load(f)
+    except:
+        last_ids = {}
+
+    return last_ids.get(str(channel_id))
+
+
+def save_last_message_id(path, channel_id, message_id):
+    try:
+        with open(last_ids_path(path)) as f:
+            last_ids = json.load(f)
+    except:
+        last_ids = {}
+
+    last_ids[str(channel_id)] = message_id
+
+    with open(last_ids_path(path), 'w') as f:
+        json.dump(last_ids, f)
+
+
+# collects the messages of several users from a channel's history in a single pass, streaming it instead of holding it
+# all in memory. user_files maps each user id to the file their cleaned messages are written to, a chunk at a time.
+# after maps user ids to the last message id already in their file: those users only get newer messages, and if every
+# user has one only the history since the oldest of them is read. lines are appended to files that already exist. new
+# lines are written under a temporary name and only moved into place once the whole history has been read, so an
+# interrupted collection doesn't leave a partial file behind. progress, if given, is awaited with the number of messages
+# scanned and the number of lines found per user every progress_every messages. returns the lines found
+async def collect_history(channel, user_files, after=None, limit=99999, chunk_size=500, progress=None,
+                          progress_every=5000):
+    if after is None:
+        after = {}
+
+    cutoffs = [after.get(user_id) for user_id in user_files]
+    oldest = snowflake_time(min(cutoffs)) if cutoffs and (None not in cutoffs) else None
+
+    chunks = {user_id: [] for user_id in user_files}
+    counts = {user_id: 0 for user_id in user_files}
+    files = {user_id: open(f'{path}.part', 'wb') for user_id, path in user_files.items()}
+    newest = None
+    done = False
+
+    try:
+        scanned = 0
+        async for msg in channel.history(limit=limit, after=oldest):
+            scanned += 1
+            newest = msg.id if newest is None else max(newest, msg.id)
+
+            if (msg.author.id in chunks) and ((after.get(msg.author.id) is None) or (msg.id > after[msg.author.id])):
+                try:
+                    chunks[msg.author.id].append(f'{format.text_cleaner(msg.content)}\n'.encode('iso-8859-1'))
+                    counts[msg.author.id] += 1
+                except:
+                    pass
+
+                if len(chunks[msg.author.id]) >= chunk_size:
+                    files[msg.author.id].write(b''.join(chunks[msg.author.id]))
+                    chunks[msg.author.id] = []
+
+            if (progress is not None) and (scanned % progress_every == 0):
+                await progress(scanned, counts)
+
+        for user_id, chunk in chunks.items():
+            files[user_id].write(b''.join(chunk))
+
+        done = True
+    finally:
+        for user_id, f in files.items():
+            f.close()
+
+            if not done:
+                os.remove(f'{user_files[user_id]}.part')
+
+    for user_id, path in user_files.items():
+        if os.path.isfile(path):
+            with open(f'{path}.part', 'rb') as part, open(path, 'ab') as f:
+                f.write(part.read())
+            os.remove(f'{path}.part')
+        else:
+            os.replace(f'{path}.part', path)
+
+        if newest is not None:
+            save_last_message_id(path, channel.id, newest)
+
+    return counts
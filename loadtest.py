@@ -0,0 +1,201 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import benchmark
+import bot
+import handler
+import metrics
+import registry
+
+# drives handler.MessageHandler, the same logic main.on_message uses, with fake guilds, users and messages instead of
+# discord, to see how the bot holds up with many guilds talking at once. senders post corpus lines as messages to
+# random guilds, some from restricted roles, some mentioning the bot and some commands, while the event loop's lag is
+# sampled. e.g. `python loadtest.py --guilds 2000 --senders 200 --seconds 60 --dataset pasta`
+
+
+class FakeRole:
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeUser:
+
+    def __init__(self, user_id, roles=()):
+        self.id = user_id
+        self.name = f'user{user_id}'
+        self.roles = list(roles)
+
+
+class FakeGuild:
+
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+
+class Typing:
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+# a channel that counts what's posted to it. api_latency is how long each post takes, like a round trip to discord
+class FakeChannel:
+
+    def __init__(self, channel_id, stats, api_latency=0.0):
+        self.id = channel_id
+        self.stats = stats
+        self.api_latency = api_latency
+
+    def typing(self):
+        return Typing()
+
+    async def send(self, text):
+        self.stats['posts'] += 1
+        await asyncio.sleep(self.api_latency)
+
+
+class FakeMessage:
+
+    def __init__(self, content, author, channel, guild, mentions=()):
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.mentions = list(mentions)
+
+    async def reply(self, text):
+        self.channel.stats['replies'] += 1
+        await asyncio.sleep(self.channel.api_latency)
+
+
+class FakeClient:
+
+    def __init__(self, stats):
+        self.user = FakeUser(0)
+        self.stats = stats
+
+    async def process_commands(self, message):
+        self.stats['commands'] += 1
+
+
+async def monitor_lag(lags, interval=0.01):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def run(args):
+    stats = {'messages': 0, 'posts': 0, 'replies': 0, 'commands': 0}
+    client = FakeClient(stats)
+    restricted = FakeRole('Vending Machine')
+
+    guilds = [FakeGuild(guild_id) for guild_id in range(1, args.guilds + 1)]
+    channels = {guild.id: FakeChannel(guild.id * 10, stats, api_latency=args.api_latency) for guild in guilds}
+    users = [FakeUser(user_id, roles=[restricted] if random.random() < args.restricted else [])
+             for user_id in range(1, args.users + 1)]
+
+    def make_bot(guild_id, saved_settings=None):
+        guild_bot = bot.Bot(guild_id, None)
+        guild_bot.apply_settings(saved_settings)
+        guild_bot.gifs_enabled = False
+
+        return guild_bot
+
+    # every guild has set its channel, as if it had been set up before a restart, so bots are made as guilds talk
+    bots = registry.BotRegistry(make_bot, idle_timeout=args.idle_seconds)
+    model_source = ['train', args.dataset, None, {}] if args.dataset else None
+    for guild in guilds:
+        bots.saved[guild.id] = {'channel_id': channels[guild.id].id, 'random_wait': args.random_wait,
+                                'mention_wait': args.mention_wait, 'msgs_wait': args.msgs_wait,
+                                'model_source': model_source}
+
+    message_handler = handler.MessageHandler(client, bots)
+    lines = benchmark.corpus_lines()
+    latencies = []
+    lags = []
+    deadline = time.perf_counter() + args.seconds
+    pause = args.senders / args.rate if args.rate else 0
+
+    async def sender():
+        while time.perf_counter() < deadline:
+            guild = random.choice(guilds)
+            content = next(lines)
+            if random.random() < args.command_chance:
+                content = '$status'
+
+            message = FakeMessage(content, random.choice(users), channels[guild.id], guild,
+                                  mentions=[client.user] if random.random() < args.mention_chance else [])
+
+            start = time.perf_counter()
+            await message_handler.handle(message)
+            latencies.append(time.perf_counter() - start)
+            stats['messages'] += 1
+
+            await asyncio.sleep(pause)
+
+    monitor = asyncio.ensure_future(monitor_lag(lags))
+    evictor = asyncio.ensure_future(bots.run_eviction(interval=max(1, args.idle_seconds / 2)))
+    start_rss = benchmark.rss_bytes()
+    start = time.perf_counter()
+
+    await asyncio.gather(*(sender() for i in range(args.senders)))
+
+    elapsed = time.perf_counter() - start
+    monitor.cancel()
+    evictor.cancel()
+
+    return {'args': vars(args), 'elapsed': elapsed, **stats, 'messages_per_second': stats['messages'] / elapsed,
+            'handle_latency': benchmark.percentiles(latencies), 'loop_lag': benchmark.percentiles(lags),
+            'guilds_loaded': len(bots), 'memory_growth': benchmark.rss_bytes() - start_rss,
+            'stages': [dict(zip(('stage', 'count', 'mean', 'p50', 'p95', 'p99', 'max'), row))
+                       for row in metrics.summary()]}
+
+
+def ms(seconds):
+    return f'{seconds * 1000:.2f}ms'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load tests the message handling logic without discord')
+    parser.add_argument('--guilds', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--senders', type=int, default=100, help='messages being handled at once')
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--rate', type=float, default=0, help='messages per second across all senders, 0 for no limit')
+    parser.add_argument('--dataset', default=None, help='data set every guild is trained on, i.e. pasta')
+    parser.add_argument('--restricted', type=float, default=0.1, help='share of users with a restricted role')
+    parser.add_argument('--mention-chance', type=float, default=0.05)
+    parser.add_argument('--command-chance', type=float, default=0.01)
+    parser.add_argument('--random-wait', type=float, default=0.05, help='random take cooldown in minutes')
+    parser.add_argument('--mention-wait', type=float, default=0.02, help='mention reply cooldown in minutes')
+    parser.add_argument('--msgs-wait', type=int, default=10)
+    parser.add_argument('--idle-seconds', type=float, default=3600, help='how long until an unused bot is unloaded')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='seconds each post to discord takes')
+    parser.add_argument('--metrics', action='store_true', help='also time each stage of handling')
+    parser.add_argument('--out', default=None, help='file to write the results to as json')
+    args = parser.parse_args()
+
+    metrics.enabled = args.metrics
+    results = asyncio.run(run(args))
+
+    print(f'{results["messages"]} messages in {results["elapsed"]:.1f}s ({results["messages_per_second"]:.0f}/s), '
+          f'{results["replies"]} replies, {results["posts"]} random posts, {results["commands"]} commands')
+    print(f'{results["guilds_loaded"]} guilds loaded, memory grew {results["memory_growth"] / 2**20:.1f}MB')
+    for name in ('handle_latency', 'loop_lag'):
+        p = results[name]
+        if p:
+            print(f'{name}: p50 {ms(p["p50"])} p95 {ms(p["p95"])} p99 {ms(p["p99"])} max {ms(p["max"])}')
+    for stage in results['stages']:
+        print(f'  {stage["stage"]:<14} {stage["count"]:>8} mean {ms(stage["mean"])} p99 {ms(stage["p99"])}')
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -1,12 +1,17 @@
+import asyncio
 import discord
 import os
-import random
-import time
 from discord.ext import commands
 from dotenv import load_dotenv
 
 import bot
 import commands
+import gifs
+import handler
+import metrics
+import registry
+import settings
+import workers
 
 cmd_prefix = '$'
 
@@ -19,110 +24,120 @@ except:
     TENOR_TOKEN = None
     print('No Tenor token found. GIFs will be disabled')
 
+# SHARD_ID and SHARD_COUNT (set by `python shards.py`) make this process one of several, each connected to discord as
+# one shard and only handling that shard's guilds
+shard_id = int(os.getenv('SHARD_ID')) if os.getenv('SHARD_ID') else None
+shard_count = int(os.getenv('SHARD_COUNT')) if shard_id is not None else None
+shard = (shard_id, shard_count) if shard_id is not None else None
+
+# number of threads used for training and generation across all guilds, defaults to the executor's own sizing
+workers.configure(max_workers=int(os.getenv('WORKERS')) if os.getenv('WORKERS') else None)
+
+# METRICS=1 times each stage of handling messages from the start (see $perf), and METRICS_PORT serves the timings at
+# http://127.0.0.1:<port>/metrics for prometheus. shards serve theirs on the ports after it, one each
+metrics.enabled = os.getenv('METRICS') == '1'
+metrics_port = int(os.getenv('METRICS_PORT')) + (shard_id or 0) if os.getenv('METRICS_PORT') else None
+metrics_server = None
+
+# TENOR_URL points gif searches at another tenor-compatible server, i.e. `python gifs.py stub` for testing
+gifs.configure(url=os.getenv('TENOR_URL'))
+
 intents = discord.Intents.default()
 intents.members = True
-client = discord.ext.commands.Bot(command_prefix=cmd_prefix, intents=intents)
+client = discord.ext.commands.Bot(command_prefix=cmd_prefix, intents=intents, shard_id=shard_id,
+                                  shard_count=shard_count)
 
-bots = {}
+# guild settings are kept between restarts in SETTINGS_DB, settings.db by default
+store = settings.SettingsStore(os.getenv('SETTINGS_DB') or 'settings.db')
 
-restricted_roles = ['Vending Machine', 'Vanilla Warrior']
 
+def make_bot(guild_id, saved_settings=None):
+    guild_bot = bot.Bot(guild_id, TENOR_TOKEN)
 
-@client.event
-async def on_ready():
-    for guild in client.guilds:
-        bots[guild.id] = bot.Bot(guild.id, TENOR_TOKEN)
+    # the model saved settings were using is only made again when the guild first uses its bot
+    if saved_settings is not None:
+        guild_bot.apply_settings(saved_settings)
 
-        if TENOR_TOKEN is None:
-            bots[guild.id].gifs_enabled = False
+    if TENOR_TOKEN is None:
+        guild_bot.gifs_enabled = False
 
-        await guild.get_member(client.user.id).edit(nick=None)
+    return guild_bot
 
-    print('Logged in as {0.user}'.format(client))
+
+# guilds get a bot when they first need one, which is unloaded after IDLE_MINUTES (60 by default) without being used
+bots = registry.BotRegistry(make_bot, store=store, idle_timeout=float(os.getenv('IDLE_MINUTES') or 60) * 60,
+                            shard=shard)
+# what loaded guilds' models learn is saved every SAVE_MINUTES (10 by default), and at shutdown
+save_interval = float(os.getenv('SAVE_MINUTES') or 10) * 60
+
+restricted_roles = ['Vending Machine', 'Vanilla Warrior']
+
+message_handler = handler.MessageHandler(client, bots, cmd_prefix=cmd_prefix, tenor_token=TENOR_TOKEN,
+                                         restricted_roles=restricted_roles)
 
 
 @client.event
-async def on_message(message):
-    guild_id = message.guild.id
-    bot = bots[guild_id]
+async def on_ready():
+    global metrics_server
 
-    # do not respond to own messages, pins, or messages from unpermitted roles
-    if (message.author == client.user) \
-            or (message.type != discord.MessageType.default) \
-            or (bot.restricted and not is_permitted(message.author)):
-        return
-    # respond to commands
-    elif message.content.startswith(cmd_prefix):
-        await client.process_commands(message)
-        return
+    asyncio.ensure_future(reset_nicknames(client.guilds))
+    asyncio.ensure_future(bots.run_eviction())
+    asyncio.ensure_future(bots.run_saving(interval=save_interval))
+
+    if (metrics_port is not None) and (metrics_server is None):
+        metrics_server = await metrics.serve(metrics_port, gauges=bot_gauges)
 
-    # if the message was posted in the bot's set channel, log it -- otherwise ignore it
-    if message.channel.id == bot.channel_id:
-        # if bot is set to warlocks only and the message is sent from a non-warlock, do not train. else train
-        if bot.restricted & (not is_permitted(message.author)):
-            return
-        else:
-            if len(bot.previous_messages) >= 10:
-                bot.previous_messages = bot.previous_messages[1:]
-            bot.previous_messages.append(message.content)
-            bot.msgs_waited += 1 # increment the anti-spam message counter
-            await bot.train(message)
+    if shard is None:
+        print('Logged in as {0.user}'.format(client))
     else:
-        return
+        print('Logged in as {0.user} (shard {1} of {2})'.format(client, shard_id, shard_count))
 
-    # respond to mentions if ready
-    if client.user in message.mentions:
-        # check if there is an outstanding cooldown for the user
-        if message.author.id in bot.user_mention_times.keys():
-            # check if the cooldown time has elapsed
-            if cooldown_check(bot.user_mention_times[message.author.id], bot.mention_wait):
-                async with message.channel.typing():
-                    if (random.random()*100 <= bot.gif_chance) & (TENOR_TOKEN is not None) & bot.gifs_enabled:
-                        output = bot.generate_gif(seed=message.content)
-                    else:
-                        output = bot.generate_take(message=message)
-
-                    await message.reply(output)
-            # do not reply if user is on cooldown
-            else:
-                return
-        else:
-            async with message.channel.typing():
-                take = bot.generate_take(message=message)
-                await message.reply(take)
-
-        bot.start_reply_cd(message.author)
 
-        return
+# clears the bot's nickname in the guilds it has one in, a few at a time. discord.py waits out rate limits by itself, so
+# this only keeps the edits from all being queued at once
+async def reset_nicknames(guilds, concurrency=5):
+    semaphore = asyncio.Semaphore(concurrency)
 
-    # post randomly if ready
-    if cooldown_check(bot.time_of_random, bot.random_wait) and (bot.msgs_waited >= bot.msgs_wait):
-        async with message.channel.typing():
-            bot.time_of_random = time.time()
-
-            roll = random.random() * 100
-            if (roll <= bot.gif_chance) & (TENOR_TOKEN is not None) & bot.gifs_enabled:
-                output = bot.generate_gif()
-            elif roll <= bot.gif_chance + bot.rant_chance:
-                output = bot.generate_rant()
-            else:
-                output = bot.generate_take()
-
-            bot.msgs_waited = 0 # reset the anti-spam message counter to 0
-            if output is not None:
-                await message.channel.send(output)
-            else:
+    async def reset_nickname(guild):
+        async with semaphore:
+            try:
+                await guild.me.edit(nick=None)
+            except discord.HTTPException:
                 pass
 
+    await asyncio.gather(*(reset_nickname(guild) for guild in guilds if guild.me.nick is not None))
 
-def is_permitted(author):
-    roles = author.roles
-    return not any(role.name in restricted_roles for role in roles)
 
+# each loaded guild's model, for spotting the ones that are slow to generate from
+def bot_gauges():
+    gauges = [('lgx_loaded_guilds', {}, len(bots))]
 
-def cooldown_check(time_of_cooldown, cooldown_length):
-    return (time.time() - time_of_cooldown) > cooldown_length*60
+    for guild_id, guild_bot in list(bots.items()):
+        labels = {'guild': guild_id}
+        gauges += [('lgx_sentences', labels, guild_bot.model.generator.sentence_count()),
+                   ('lgx_tries_per_sentence', labels, guild_bot.model.tries_per_sentence()),
+                   ('lgx_take_buffer', labels, len(guild_bot.take_buffer))]
 
+    return gauges
 
-client.add_cog(commands.Commands(client=client, bots=bots))
+
+@client.event
+async def on_message(message):
+    # pins and other system messages are ignored
+    if message.type != discord.MessageType.default:
+        return
+
+    await message_handler.handle(message)
+
+
+client.add_cog(commands.Commands(client=client, bots=bots, store=store))
 client.run(TOKEN)
+
+# every guild still loaded is saved on the way out, along with what its model learned, so nothing changed since its
+# last command or save is lost
+for guild_id, guild_bot in bots.items():
+    if guild_bot.learned:
+        guild_bot.save_learned()
+
+    store.save(guild_id, guild_bot.get_settings())
+store.close()
@@ -0,0 +1,199 @@
+import collections
+import contextlib
+import functools
+import threading
+import time
+from aiohttp import web
+
+# how long each stage of handling messages takes, overall and per guild, and counts of events like retries and gif
+# cache hits. off unless enabled (METRICS=1 or $perf on), so instrumented code only pays for checking the flag.
+# stages are timed from the worker threads as well as the event loop, so updates are made under a lock
+enabled = False
+
+# upper bounds of the latency histogram buckets, in seconds
+buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+lock = threading.Lock()
+histograms = {}
+guild_stages = {}
+counters = collections.Counter()
+null_timer = contextlib.nullcontext()
+
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        i = 0
+        while (i < len(buckets)) and (seconds > buckets[i]):
+            i += 1
+
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    # the upper bound of the bucket the q quantile falls in, or the slowest time seen if it's past the last bucket
+    def quantile(self, q):
+        target = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts[:-1]):
+            seen += count
+            if seen >= target:
+                return buckets[i]
+
+        return self.max
+
+
+def observe(stage, seconds, guild_id=None):
+    with lock:
+        if stage not in histograms:
+            histograms[stage] = Histogram()
+        histograms[stage].observe(seconds)
+
+        if guild_id is not None:
+            stats = guild_stages.setdefault((stage, guild_id), [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+
+def count(event, guild_id=None, n=1):
+    if enabled:
+        with lock:
+            counters[(event, guild_id)] += n
+
+
+class Timer:
+    __slots__ = ('stage', 'guild_id', 'start')
+
+    def __init__(self, stage, guild_id=None):
+        self.stage = stage
+        self.guild_id = guild_id
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        observe(self.stage, time.perf_counter() - self.start, self.guild_id)
+
+
+# times the block it's used on as stage, i.e. `with metrics.timer('gif', guild_id):`
+def timer(stage, guild_id=None):
+    if not enabled:
+        return null_timer
+
+    return Timer(stage, guild_id)
+
+
+# times every call of a method as stage, for the guild of the object it's called on if it has a guild_id
+def timed(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not enabled:
+                return func(self, *args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                observe(stage, time.perf_counter() - start, getattr(self, 'guild_id', None))
+
+        return wrapper
+
+    return decorator
+
+
+def reset():
+    with lock:
+        histograms.clear()
+        guild_stages.clear()
+        counters.clear()
+
+
+# the stages timed so far, slowest mean first, as (stage, count, mean, p50, p95, p99, max) in seconds
+def summary():
+    with lock:
+        rows = [(stage, h.count, h.total / h.count, h.quantile(0.5), h.quantile(0.95), h.quantile(0.99), h.max)
+                for stage, h in histograms.items() if h.count]
+
+    return sorted(rows, key=lambda row: row[2], reverse=True)
+
+
+# a guild's stages as (stage, count, mean, max) in seconds
+def guild_summary(guild_id):
+    with lock:
+        rows = [(stage, stats[0], stats[1] / stats[0], stats[2])
+                for (stage, g), stats in guild_stages.items() if (g == guild_id) and stats[0]]
+
+    return sorted(rows, key=lambda row: row[2], reverse=True)
+
+
+# the guilds with the slowest mean time for stage, as (guild_id, count, mean, max) in seconds
+def slowest_guilds(stage, top=5):
+    with lock:
+        rows = [(g, stats[0], stats[1] / stats[0], stats[2])
+                for (s, g), stats in guild_stages.items() if (s == stage) and stats[0]]
+
+    return sorted(rows, key=lambda row: row[2], reverse=True)[:top]
+
+
+def label_text(labels):
+    if not labels:
+        return ''
+
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+
+# everything recorded in prometheus' text format. gauges is a list of (name, labels, value) measured when scraped
+def render(gauges=()):
+    lines = []
+
+    with lock:
+        lines.append('# TYPE lgx_stage_seconds histogram')
+        for stage, h in sorted(histograms.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, h.counts):
+                cumulative += bucket_count
+                lines.append(f'lgx_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'lgx_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {h.count}')
+            lines.append(f'lgx_stage_seconds_sum{{stage="{stage}"}} {h.total}')
+            lines.append(f'lgx_stage_seconds_count{{stage="{stage}"}} {h.count}')
+
+        lines.append('# TYPE lgx_guild_stage_seconds summary')
+        for (stage, guild_id), stats in sorted(guild_stages.items()):
+            lines.append(f'lgx_guild_stage_seconds_sum{{stage="{stage}",guild="{guild_id}"}} {stats[1]}')
+            lines.append(f'lgx_guild_stage_seconds_count{{stage="{stage}",guild="{guild_id}"}} {stats[0]}')
+
+        lines.append('# TYPE lgx_events_total counter')
+        for (event, guild_id), n in sorted(counters.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+            labels = {'event': event} if guild_id is None else {'event': event, 'guild': guild_id}
+            lines.append(f'lgx_events_total{label_text(labels)} {n}')
+
+    for name in sorted({name for name, labels, value in gauges}):
+        lines.append(f'# TYPE {name} gauge')
+        lines += [f'{name}{label_text(labels)} {value}' for n, labels, value in gauges if n == name]
+
+    return '\n'.join(lines) + '\n'
+
+
+# serves render() at http://127.0.0.1:port/metrics. gauges, if given, is called for the gauges on every scrape
+async def serve(port, gauges=None):
+    async def handle(request):
+        return web.Response(text=render(gauges() if gauges is not None else ()),
+                            content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+
+    return runner
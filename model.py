@@ -1,68 +1,572 @@
-import markovify
-import random
-import sys
-
-import format
-
-
-class Model:
-
-    def __init__(self, state_size=2):
-        self.root_dir = 'models/'
-        self.state_size = state_size
-        self.init_text = 'i am a bot'
-        self.no_take_text = 'cum'
-        self.smart_reply_chance = 80
-        self.generator = markovify.Text(self.init_text, state_size=state_size, well_formed=False)
-
-    def make_sentence(self, message=None, tries=30, smart_eligible=True):
-        sentence = self.generator.make_sentence(tries=tries)
-
-        if (message is not None) and (random.random() < self.smart_reply_chance/100) and smart_eligible:
-            content = format.remove_boring_words(message)
-            random.shuffle(content)
-
-            for word in content:
-                try:
-                    sentence = self.generator.make_sentence_with_start(beginning=word, tries=tries, strict=False)
-                    break
-                except markovify.text.ParamError:
-                    pass
-
-        if sentence:
-            return sentence
-        else:
-            return self.no_take_text
-
-    def update_model(self, text):
-        try:
-            new_model = markovify.Text(text, state_size=self.generator.state_size, well_formed=False)
-            self.generator = markovify.combine(models=[self.generator, new_model])
-
-        except:
-            pass
-
-    def save_model(self, model_name=None):
-        if model_name is None:
-            model_name = 'default'
-
-        try:
-            model_json = self.generator.to_json()
-            with open(f'{self.root_dir}{model_name}.json', 'w', encoding='iso-8859-1') as outfile:
-                outfile.write(model_json)
-            return 1
-        except:
-            return None
-
-    def load_model(self, model_name=None):
-        if model_name is None:
-            model_name = 'default'
-
-        try:
-            with open(f'{self.root_dir}{model_name}.json') as f:
-                model_json = f.read()
-                self.generator = markovify.Text.from_json(model_json)
-                self.state_size = self.generator.state_size
-            return 1
-        except:
-            return None
+import collections
+import hashlib
+import json
+import markovify
+import os
+import random
+import re
+import sys
+import threading
+import weakref
+from array import array
+from markovify.chain import BEGIN
+
+import format
+import metrics
+import snapshot
+from chain import Chain, OverlayChain
+
+# frozen dataset and saved-model texts keyed by (name, state size, content hash), shared by every guild that trains on
+# or loads the same thing. a text is dropped once no guild's model uses it anymore
+shared_texts = weakref.WeakValueDictionary()
+shared_texts_locks = {}
+shared_texts_lock = threading.Lock()
+
+
+# returns the shared text for key, calling build to make it if no guild holds it. builds of the same key wait on each
+# other so it's only built once
+def shared_text(key, build):
+    with shared_texts_lock:
+        # the locks of texts no guild holds anymore are dropped, unless they're being built
+        for stale_key in [k for k, lock in shared_texts_locks.items() if (k not in shared_texts) and not lock.locked()]:
+            del shared_texts_locks[stale_key]
+
+        if key not in shared_texts_locks:
+            shared_texts_locks[key] = threading.Lock()
+        key_lock = shared_texts_locks[key]
+
+    with key_lock:
+        text = shared_texts.get(key)
+
+        if text is None:
+            text = build()
+            text.freeze()
+            shared_texts[key] = text
+
+        return text
+
+
+class Text(markovify.Text):
+
+    def __init__(self, input_text, state_size=2, chain=None, parsed_sentences=None, retain_original=True,
+                 well_formed=True, reject_reg='', base=None):
+        self.well_formed = well_formed
+        if well_formed and reject_reg != '':
+            self.reject_pat = re.compile(reject_reg)
+
+        self.state_size = state_size
+        self.retain_original = retain_original
+
+        # sentences are kept only as the rejoined text used by the overlap test, plus the offset each one starts at.
+        # newly learned sentences are joined onto it the next time a sentence is generated instead of copying the whole
+        # corpus on every message
+        self.pending_sentences = []
+        self.sentence_offsets = array('q')
+        self.text_length = 0
+        if self.retain_original:
+            self.rejoined_text = ''
+
+        # sentences that failed the overlap test, so walks that keep landing on the same sentence (as they do in small
+        # models) don't scan the whole text again. a failed sentence can only pass once forgotten sentences are
+        # dropped from the text, which clears this
+        self.rejected = {}
+        self.max_rejected = 4096
+
+        # counts of walks and what became of them, to see how many tries each accepted sentence costs
+        self.generation_stats = collections.Counter()
+
+        # with a capacity, only the last capacity sentences this text learned are kept: older ones are taken back out
+        # of the chains, and dropped from the text once they make up half of it. window holds the learned runs and
+        # weights, oldest first, and forgotten counts the sentences at the start of the text that are gone
+        self.capacity = None
+        self.window = collections.deque()
+        self.forgotten = 0
+
+        if parsed_sentences is None:
+            parsed_sentences = self.generate_corpus(input_text) if input_text is not None else []
+
+        # with a base (a frozen text shared between guilds), this text only holds what it learns on top of it
+        self.base = base
+
+        if base is not None:
+            self.chain = OverlayChain(base.chain)
+            self.reverse_chain = OverlayChain(base.reverse_chain, vocab=self.chain.vocab) \
+                if base.reverse_chain is not None else None
+
+            for run in parsed_sentences:
+                self.learn_run(run)
+        elif chain is None:
+            self.chain = Chain(None, state_size)
+            self.reverse_chain = Chain(None, state_size, indexed=False, vocab=self.chain.vocab)
+
+            for run in parsed_sentences:
+                self.learn_run(run)
+        else:
+            # the reverse chain can only be rebuilt from the original sentences
+            self.chain = chain
+            self.reverse_chain = None
+            if parsed_sentences:
+                self.reverse_chain = Chain(None, state_size, indexed=False, vocab=self.chain.vocab)
+
+            for run in parsed_sentences:
+                self.reverse_chain.learn(run[::-1])
+                self.add_sentence(run)
+
+    @classmethod
+    def from_dict(cls, obj, **kwargs):
+        return cls(None, state_size=obj['state_size'], chain=Chain.from_json(obj['chain']),
+                   parsed_sentences=obj.get('parsed_sentences'), **kwargs)
+
+    @property
+    def rejoined_text(self):
+        if self.pending_sentences:
+            if self._rejoined_text:
+                self.pending_sentences.insert(0, self._rejoined_text)
+
+            self._rejoined_text = self.sentence_join(self.pending_sentences)
+            self.pending_sentences = []
+
+        return self._rejoined_text
+
+    @rejoined_text.setter
+    def rejoined_text(self, text):
+        self._rejoined_text = text
+        self.pending_sentences = []
+
+    # the original sentences as lists of words, rebuilt from the rejoined text. only used to export the model
+    @property
+    def parsed_sentences(self):
+        sentences = self.own_sentences()
+        return sentences if self.base is None else self.base.parsed_sentences + sentences
+
+    # the sentences of this text, not its base
+    def own_sentences(self):
+        self.compact()
+
+        text = self.rejoined_text
+        ends = list(self.sentence_offsets[1:]) + [len(text) + 1]
+        return [self.word_split(text[start:end - 1]) for start, end in zip(self.sentence_offsets, ends)]
+
+    def sentence_count(self):
+        own = len(self.sentence_offsets) - self.forgotten
+        return own + (self.base.sentence_count() if self.base is not None else 0)
+
+    # the rejoined text and sentence offsets, including the base's
+    def sentence_data(self):
+        self.compact()
+
+        if self.base is None:
+            return self.rejoined_text, self.sentence_offsets
+
+        base_text, base_offsets = self.base.sentence_data()
+        if not self.sentence_offsets:
+            return base_text, base_offsets
+        if not base_offsets:
+            return self.rejoined_text, self.sentence_offsets
+
+        shift = len(base_text) + 1
+        offsets = array('q', base_offsets)
+        offsets.extend(offset + shift for offset in self.sentence_offsets)
+
+        return self.sentence_join([base_text, self.rejoined_text]), offsets
+
+    # the base keeps its own rejoined text, so it checks its own overlap instead of copying its text into every guild's
+    def test_sentence_output(self, words, max_overlap_ratio, max_overlap_total):
+        if self.base is not None:
+            if not self.base.test_sentence_output(words, max_overlap_ratio, max_overlap_total):
+                return False
+
+        return super().test_sentence_output(words, max_overlap_ratio, max_overlap_total)
+
+    def add_sentence(self, run):
+        if not self.retain_original:
+            return
+
+        sentence = self.word_join(run)
+        offset = self.text_length + 1 if self.sentence_offsets else 0
+
+        self.sentence_offsets.append(offset)
+        self.text_length = offset + len(sentence)
+        self.pending_sentences.append(sentence)
+
+    # swaps the chains for read-only flat copies, which take a fraction of the memory. learning thaws them again. the
+    # rejoined text is joined now too, as frozen texts can be shared between threads that would otherwise all join it
+    def freeze(self):
+        if self.retain_original:
+            self.rejoined_text
+
+        if not self.chain.frozen:
+            self.chain = self.chain.freeze()
+
+        if (self.reverse_chain is not None) and (not self.reverse_chain.frozen):
+            self.reverse_chain = self.reverse_chain.freeze()
+
+    def thaw(self):
+        if self.chain.frozen:
+            self.chain = self.chain.thaw()
+
+            if self.reverse_chain is not None:
+                self.reverse_chain = self.reverse_chain.thaw()
+
+    def learn_run(self, run, weight=1):
+        self.thaw()
+        self.chain.learn(run, weight=weight)
+
+        if self.reverse_chain is not None:
+            self.reverse_chain.learn(run[::-1], weight=weight)
+
+        self.add_sentence(run)
+
+        if self.capacity is not None:
+            self.window.append((run, weight))
+            self.forget()
+
+    # limits the text to its last capacity sentences, or lifts the limit with None. sentences learned before a limit
+    # was set are read back from the text, and were learned with weight 1 unless they came from a weighted corpus
+    def set_capacity(self, capacity):
+        if capacity is None:
+            self.window.clear()
+        elif (self.capacity is None) and self.retain_original:
+            self.window = collections.deque((run, 1) for run in self.own_sentences())
+
+        self.capacity = capacity
+
+        if capacity is not None:
+            self.forget()
+
+    def forget(self):
+        while len(self.window) > self.capacity:
+            self.thaw()
+            run, weight = self.window.popleft()
+
+            self.chain.unlearn(run, weight=weight)
+            if self.reverse_chain is not None:
+                self.reverse_chain.unlearn(run[::-1], weight=weight)
+
+            if self.retain_original:
+                self.forgotten += 1
+
+        if self.forgotten * 2 > len(self.sentence_offsets):
+            self.compact()
+
+    # drops forgotten sentences from the start of the text
+    def compact(self):
+        if self.forgotten == 0:
+            return
+
+        text = self.rejoined_text
+
+        if self.forgotten >= len(self.sentence_offsets):
+            self.rejoined_text = ''
+            self.sentence_offsets = array('q')
+            self.text_length = 0
+        else:
+            start = self.sentence_offsets[self.forgotten]
+            self.rejoined_text = text[start:]
+            self.sentence_offsets = array('q', (offset - start for offset in self.sentence_offsets[self.forgotten:]))
+            self.text_length -= start
+
+        self.forgotten = 0
+        self.rejected.clear()
+
+    def learn(self, text, weight=1):
+        runs = list(self.generate_corpus(text))
+
+        for run in runs:
+            self.learn_run(run, weight=weight)
+
+        return len(runs)
+
+    # returns the sentence of words if it can be posted, or None if it's in exclude (any container of sentences, like
+    # the takes posted recently) or fails the overlap test
+    def accept(self, words, exclude=None, max_overlap_ratio=markovify.text.DEFAULT_MAX_OVERLAP_RATIO,
+               max_overlap_total=markovify.text.DEFAULT_MAX_OVERLAP_TOTAL, test_output=True):
+        sentence = self.word_join(words)
+        self.generation_stats['walks'] += 1
+
+        if (exclude is not None) and (sentence in exclude):
+            self.generation_stats['excluded'] += 1
+            return None
+
+        if test_output and hasattr(self, 'rejoined_text'):
+            key = (sentence, max_overlap_ratio, max_overlap_total)
+
+            if key in self.rejected:
+                self.generation_stats['rejected_cached'] += 1
+                return None
+
+            if not self.test_sentence_output(words, max_overlap_ratio, max_overlap_total):
+                self.generation_stats['rejected'] += 1
+
+                if len(self.rejected) >= self.max_rejected:
+                    del self.rejected[next(iter(self.rejected))]
+                self.rejected[key] = True
+                return None
+
+        self.generation_stats['accepted'] += 1
+        return sentence
+
+    # markovify's make_sentence, with every walk checked by accept so sentences in exclude are retried within the same
+    # tries instead of by the caller generating whole new sentences
+    def make_sentence(self, init_state=None, tries=markovify.text.DEFAULT_TRIES, exclude=None,
+                      max_overlap_ratio=markovify.text.DEFAULT_MAX_OVERLAP_RATIO,
+                      max_overlap_total=markovify.text.DEFAULT_MAX_OVERLAP_TOTAL, test_output=True, max_words=None,
+                      min_words=None):
+        prefix = [] if init_state is None else [word for word in init_state if word != BEGIN]
+
+        for i in range(tries):
+            words = prefix + self.chain.walk(init_state)
+
+            if ((max_words is not None) and (len(words) > max_words)) \
+                    or ((min_words is not None) and (len(words) < min_words)):
+                continue
+
+            sentence = self.accept(words, exclude=exclude, max_overlap_ratio=max_overlap_ratio,
+                                   max_overlap_total=max_overlap_total, test_output=test_output)
+            if sentence is not None:
+                return sentence
+
+        return None
+
+    # looks up the states starting with the split in the chain's word index instead of scanning the whole chain
+    def find_init_states_from_chain(self, split):
+        return [state for state in self.chain.states_with(split[0])
+                if tuple(word for word in state if word != BEGIN)[:len(split)] == split]
+
+    # tries making a sentence containing word, which the chain must know. with mid_sentence, the word can land anywhere
+    # in the sentence: the chain walks forward from a state starting with the word and the reverse chain walks backward
+    # from it to a sentence start
+    def make_sentence_with_word(self, word, mid_sentence=False, tries=markovify.text.DEFAULT_TRIES, exclude=None,
+                                max_overlap_ratio=markovify.text.DEFAULT_MAX_OVERLAP_RATIO,
+                                max_overlap_total=markovify.text.DEFAULT_MAX_OVERLAP_TOTAL):
+        if not self.chain.knows(word):
+            return None
+
+        for i in range(tries):
+            init_state = self.chain.random_state_with(word)
+            words = [w for w in init_state if w != BEGIN] + self.chain.walk(init_state)
+
+            if mid_sentence and (self.reverse_chain is not None) and (init_state[0] != BEGIN):
+                words = self.reverse_chain.walk(init_state[::-1])[::-1] + words
+
+            sentence = self.accept(words, exclude=exclude, max_overlap_ratio=max_overlap_ratio,
+                                   max_overlap_total=max_overlap_total)
+            if sentence is not None:
+                return sentence
+
+        return None
+
+
+class Model:
+
+    def __init__(self, state_size=2):
+        self.root_dir = 'models/'
+        self.cache_dir = 'cache/'
+        self.state_size = state_size
+        self.init_text = 'i am a bot'
+        self.no_take_text = 'cum'
+        self.smart_reply_chance = 80
+        self.mid_sentence_chance = 50
+
+        # chain statistics a model needs before it is likely to produce distinct sentences
+        self.min_ready_sentences = 100
+        self.min_ready_begins = 75
+        self.min_ready_branching = 1.12
+
+        # maximum number of sentences the model keeps learning from conversation, oldest forgotten first. None keeps
+        # everything
+        self.learn_limit = None
+        # words never used to seed a reply, None for the ones in filter.txt
+        self.stopwords = None
+
+        self.generator = Text(self.init_text, state_size=state_size, well_formed=False)
+
+    # generates a sentence, seeded by a word from message if it has one the model knows. sentences in exclude are
+    # skipped while generating
+    @metrics.timed('make_sentence')
+    def make_sentence(self, message=None, tries=30, smart_eligible=True, exclude=None):
+        sentence = None
+
+        if (message is not None) and (random.random() < self.smart_reply_chance/100) and smart_eligible:
+            # only words the model has seen can seed a sentence
+            content = [word for word in format.remove_boring_words(message, self.stopwords) if self.generator.chain.knows(word)]
+            random.shuffle(content)
+
+            for word in content:
+                sentence = self.generator.make_sentence_with_word(
+                    word, mid_sentence=random.random() < self.mid_sentence_chance/100, tries=tries, exclude=exclude)
+
+                if sentence:
+                    break
+
+        if not sentence:
+            sentence = self.generator.make_sentence(tries=tries, exclude=exclude)
+
+        if sentence:
+            return sentence
+        else:
+            return self.no_take_text
+
+    def is_ready(self):
+        c = self.generator.chain
+        return (c.sentence_count() >= self.min_ready_sentences) and (c.begin_count() >= self.min_ready_begins) \
+            and (c.branching_factor() >= self.min_ready_branching)
+
+    # mean number of walks each accepted sentence has cost
+    def tries_per_sentence(self):
+        stats = self.generator.generation_stats
+        return stats['walks'] / stats['accepted'] if stats['accepted'] else float(stats['walks'])
+
+    @metrics.timed('update_model')
+    def update_model(self, text):
+        try:
+            # a new generator (after training or loading) takes on the model's limit when it first learns
+            if self.generator.capacity != self.learn_limit:
+                self.generator.set_capacity(self.learn_limit)
+
+            self.generator.learn(text)
+        except:
+            pass
+
+    # builds a fresh generator in a single pass over a corpus of (lines, weight) pairs, where each weight multiplies the
+    # counts of every sentence in its lines. a corpus with a name and content hash is shared with every other guild
+    # building the same one and cached on disk, and this model only learns on top of it. files are the names of the
+    # files a corpus was picked from, or None if it's all of them
+    @metrics.timed('build_model')
+    def build_model(self, corpus, name=None, content_hash=None, files=None):
+        if name is None:
+            generator = self.build_text(corpus)
+
+            # trained models don't learn unless told to, so keep them in the compact read-only form
+            generator.freeze()
+            self.generator = generator
+        else:
+            base = shared_text((name, self.state_size, content_hash),
+                               lambda: self.cached_text(corpus, name, content_hash, files))
+            self.generator = Text(None, state_size=self.state_size, well_formed=False, base=base)
+
+    def build_text(self, corpus):
+        generator = Text(self.init_text, state_size=self.state_size, well_formed=False)
+
+        for lines, weight in corpus:
+            try:
+                generator.learn(lines, weight=weight)
+            except:
+                pass
+
+        return generator
+
+    # loads a corpus's chain from its snapshot in the cache, so training on it again (even after a restart) skips
+    # reading, cleaning and parsing the files. snapshots are per corpus, state size and set of files picked from it, and
+    # named by content hash, so changed files miss the cache and the stale snapshot of that set is replaced
+    def cached_text(self, corpus, name, content_hash, files=None):
+        if files is None:
+            file_set = 'all'
+        else:
+            file_set = hashlib.sha1('\0'.join(sorted(files)).encode()).hexdigest()[:16]
+
+        cache_dir = f'{self.cache_dir}{os.path.basename(name)}/'
+        prefix = f'{self.state_size}-{file_set}-'
+        cache_path = f'{cache_dir}{prefix}{content_hash}.lgx'
+
+        try:
+            return snapshot.load(cache_path, Text)
+        except:
+            pass
+
+        generator = self.build_text(corpus)
+        generator.freeze()
+
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # other processes may be writing this snapshot too, so only finished ones of the same files with other
+            # contents are removed. other picks of files from the corpus keep theirs
+            for f in os.listdir(cache_dir):
+                if f.startswith(prefix) and f.endswith('.lgx') and (f'{cache_dir}{f}' != cache_path):
+                    os.remove(f'{cache_dir}{f}')
+
+            snapshot.save(generator, cache_path)
+
+            # the mapped copy lives in the page cache instead of the heap
+            return snapshot.load(cache_path, Text)
+        except:
+            return generator
+
+    # saves a binary snapshot, or markovify's json with fmt='json'
+    def save_model(self, model_name=None, fmt='snapshot'):
+        if model_name is None:
+            model_name = 'default'
+
+        try:
+            os.makedirs(self.root_dir, exist_ok=True)
+
+            if fmt == 'json':
+                model_json = self.generator.to_json()
+                with open(f'{self.root_dir}{model_name}.json', 'w', encoding='utf-8') as outfile:
+                    outfile.write(model_json)
+
+                # loading prefers a snapshot, so an older one of the same name would hide this
+                if os.path.isfile(f'{self.root_dir}{model_name}.lgx'):
+                    os.remove(f'{self.root_dir}{model_name}.lgx')
+            else:
+                snapshot.save(self.generator, f'{self.root_dir}{model_name}.lgx')
+            return 1
+        except:
+            return None
+
+    # saves only the sentences the model learned on top of its base (or all of them, without one) as json, for a model
+    # whose base can be made again from where it came from
+    def save_learned(self, model_name):
+        try:
+            os.makedirs(self.root_dir, exist_ok=True)
+
+            with open(f'{self.root_dir}{model_name}.learned.json', 'w', encoding='utf-8') as outfile:
+                json.dump(self.generator.own_sentences(), outfile)
+            return 1
+        except:
+            return None
+
+    # learns the sentences saved by save_learned on top of the model. a model without a base is made from the saved
+    # sentences alone, as they include the text it started with
+    def load_learned(self, model_name):
+        try:
+            with open(f'{self.root_dir}{model_name}.learned.json', encoding='utf-8') as f:
+                runs = json.load(f)
+
+            if (self.generator.base is None) and runs:
+                self.generator = Text(None, state_size=self.state_size, well_formed=False)
+
+            if self.generator.capacity != self.learn_limit:
+                self.generator.set_capacity(self.learn_limit)
+
+            for run in runs:
+                self.generator.learn_run(run)
+            return 1
+        except:
+            return None
+
+    # loads the model's snapshot if it has one, otherwise its json
+    @metrics.timed('load_model')
+    def load_model(self, model_name=None):
+        if model_name is None:
+            model_name = 'default'
+
+        try:
+            # every guild loading the same file shares one frozen copy of it
+            snapshot_path = f'{self.root_dir}{model_name}.lgx'
+            if os.path.isfile(snapshot_path):
+                stat = os.stat(snapshot_path)
+                key = (snapshot_path, None, (stat.st_mtime_ns, stat.st_size))
+                base = shared_text(key, lambda: snapshot.load(snapshot_path, Text))
+            else:
+                with open(f'{self.root_dir}{model_name}.json', 'rb') as f:
+                    model_json = f.read()
+
+                key = (f'{self.root_dir}{model_name}.json', None, hashlib.sha1(model_json).hexdigest())
+                base = shared_text(key, lambda: Text.from_json(model_json.decode('utf-8')))
+
+            self.generator = Text(None, state_size=base.state_size, well_formed=base.well_formed, base=base)
+            self.state_size = self.generator.state_size
+            return 1
+        except:
+            return None
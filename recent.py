@@ -0,0 +1,85 @@
+import collections
+import itertools
+
+import format
+
+
+# the last size takes a guild posted, for checking new takes against in constant time however large the window is.
+# takes are compared by a normalized form (lower case, no punctuation), so cleaning a take again doesn't make it look
+# new. a take is also a near-duplicate of a remembered one if at least near_duplicate_ratio of its shingles (runs of
+# shingle_size words) are in that take; the shingles are indexed, so a check only looks at takes sharing one
+class RecentTakes:
+
+    def __init__(self, size=20, shingle_size=3, near_duplicate_ratio=0.8):
+        self.size = size
+        self.shingle_size = shingle_size
+        self.near_duplicate_ratio = near_duplicate_ratio
+
+        self.takes = collections.deque()
+        self.counts = collections.Counter()
+        self.shingle_index = {}
+        self.ids = itertools.count()
+
+    # generated sentences are compared before they're cleaned, so censoring is part of normalizing
+    def normalize(self, text):
+        return format.remove_all_punctuation(format.censor_mage(text).lower()).split()
+
+    def shingles(self, words):
+        return {hash(tuple(words[i:i + self.shingle_size])) for i in range(len(words) - self.shingle_size + 1)}
+
+    def add(self, text):
+        words = self.normalize(text)
+        key = ' '.join(words)
+        take_id = next(self.ids)
+        shingles = self.shingles(words)
+
+        self.takes.append((take_id, key, shingles))
+        self.counts[key] += 1
+        for shingle in shingles:
+            self.shingle_index.setdefault(shingle, set()).add(take_id)
+
+        self.trim()
+
+    def trim(self):
+        while len(self.takes) > self.size:
+            take_id, key, shingles = self.takes.popleft()
+
+            self.counts[key] -= 1
+            if self.counts[key] <= 0:
+                del self.counts[key]
+
+            for shingle in shingles:
+                self.shingle_index[shingle].discard(take_id)
+                if not self.shingle_index[shingle]:
+                    del self.shingle_index[shingle]
+
+    def resize(self, size):
+        self.size = size
+        self.trim()
+
+    def clear(self):
+        self.takes.clear()
+        self.counts.clear()
+        self.shingle_index.clear()
+
+    def __len__(self):
+        return len(self.takes)
+
+    def __contains__(self, text):
+        words = self.normalize(text)
+        if ' '.join(words) in self.counts:
+            return True
+
+        if self.near_duplicate_ratio is None:
+            return False
+
+        # takes too short to have two shingles only match exactly
+        shingles = self.shingles(words)
+        if len(shingles) < 2:
+            return False
+
+        shared = collections.Counter()
+        for shingle in shingles:
+            shared.update(self.shingle_index.get(shingle, ()))
+
+        return (len(shared) > 0) and (max(shared.values()) >= self.near_duplicate_ratio * len(shingles))
@@ -0,0 +1,119 @@
+import asyncio
+import time
+
+import metrics
+
+
+# each guild's bot, made the first time the guild needs it rather than at startup. factory(guild_id, settings) makes a
+# bot from the settings saved for the guild, or None if it has none. bots left unused for idle_timeout seconds are
+# unloaded: their settings go back to the store, along with a save of anything their model learned, and they're made
+# again from those if the guild comes back. shard is (shard_id, shard_count) when this process only has one
+# shard's guilds
+class BotRegistry(dict):
+
+    def __init__(self, factory, store=None, idle_timeout=3600, shard=None):
+        super().__init__()
+        self.factory = factory
+        self.store = store
+        self.idle_timeout = idle_timeout
+
+        self.last_used = {}
+        self.evicting = False
+        self.saving = False
+
+        # every guild's saved settings, read in one query. unloaded bots are kept up to date here too
+        self.saved = store.load_all(shard=shard) if store is not None else {}
+
+    def __getitem__(self, guild_id):
+        self.last_used[guild_id] = time.monotonic()
+        return super().__getitem__(guild_id)
+
+    def __missing__(self, guild_id):
+        bot = self.factory(guild_id, self.saved.get(guild_id))
+        self[guild_id] = bot
+
+        return bot
+
+    # whether a message in channel_id needs the guild's bot: it's loaded already, or the message is in its channel
+    def relevant(self, guild_id, channel_id):
+        return (guild_id in self) or (self.saved.get(guild_id, {}).get('channel_id') == channel_id)
+
+    def idle(self):
+        now = time.monotonic()
+
+        return [guild_id for guild_id, bot in self.items()
+                if (now - self.last_used.get(guild_id, now) > self.idle_timeout)
+                and (not bot.lock.locked()) and (not bot.refilling)]
+
+    # unloads the guild's bot, returning whether it was. a bot whose model couldn't be saved, or that's used while it's
+    # being saved, is kept
+    async def evict(self, guild_id):
+        bot = self.get(guild_id)
+        if bot is None:
+            return False
+
+        last_used = self.last_used.get(guild_id)
+        if bot.learned:
+            await bot.run_serialized(bot.save_learned)
+
+        if bot.learned or (self.last_used.get(guild_id) != last_used) or bot.refilling:
+            return False
+
+        self.save_settings(guild_id, bot)
+
+        del self[guild_id]
+        self.last_used.pop(guild_id, None)
+        metrics.count('evictions')
+
+        return True
+
+    def save_settings(self, guild_id, bot):
+        settings = bot.get_settings()
+        self.saved[guild_id] = settings
+        if self.store is not None:
+            self.store.save(guild_id, settings)
+            self.store.schedule_flush()
+
+    # saves what each loaded bot's model has learned since it was last saved, returning how many were
+    async def save_learned(self):
+        saved = 0
+        for guild_id, bot in list(self.items()):
+            if bot.learned:
+                await bot.run_serialized(bot.save_learned)
+                self.save_settings(guild_id, bot)
+                saved += 1
+
+        return saved
+
+    async def evict_idle(self):
+        evicted = 0
+        for guild_id in self.idle():
+            evicted += await self.evict(guild_id)
+
+        return evicted
+
+    # checks for idle bots every interval seconds. only one of these runs, however many times it's started
+    async def run_eviction(self, interval=300):
+        if self.evicting:
+            return
+
+        self.evicting = True
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                await self.evict_idle()
+        finally:
+            self.evicting = False
+
+    # saves learned models every interval seconds, so a crash only loses what was learned since. only one of these runs
+    async def run_saving(self, interval=600):
+        if self.saving:
+            return
+
+        self.saving = True
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                await self.save_learned()
+        finally:
+            self.saving = False
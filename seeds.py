@@ -0,0 +1,71 @@
+import collections
+import random
+
+import format
+
+
+# the words of the last size messages a guild posted, for seeding takes and gifs with what the conversation is about.
+# every non-boring word is kept once per time it was used, so picking a random one picks words in proportion to how
+# often they've come up lately. counts are kept as messages come and go, so the most used words are always at hand.
+# words are counted regardless of case, but seeded with the case they were last used with, as the chains are case
+# sensitive
+class SeedIndex:
+
+    def __init__(self, size=10):
+        self.size = size
+        # words never used as seeds, None for the ones in filter.txt
+        self.stopwords = None
+
+        self.messages = collections.deque()
+        self.words = collections.deque()
+        self.counts = collections.Counter()
+        self.forms = {}
+
+    def tokenize(self, text):
+        return [word for word in format.remove_boring_words(text, self.stopwords) if not word.startswith('http')]
+
+    def add(self, text):
+        words = self.tokenize(text)
+        keys = [word.lower() for word in words]
+
+        self.messages.append(len(keys))
+        self.words.extend(keys)
+        self.counts.update(keys)
+        self.forms.update(zip(keys, words))
+
+        self.trim()
+
+    def trim(self):
+        while len(self.messages) > self.size:
+            for i in range(self.messages.popleft()):
+                word = self.words.popleft()
+
+                self.counts[word] -= 1
+                if self.counts[word] <= 0:
+                    del self.counts[word]
+                    del self.forms[word]
+
+    def resize(self, size):
+        self.size = size
+        self.trim()
+
+    def clear(self):
+        self.messages.clear()
+        self.words.clear()
+        self.counts.clear()
+        self.forms.clear()
+
+    def __len__(self):
+        return len(self.messages)
+
+    # up to count different words, each picked with a chance in proportion to how often it was used recently, joined
+    # into seed text. None if nothing worth seeding with has been said
+    def seed_words(self, count=3):
+        if not self.words:
+            return None
+
+        seeds = dict.fromkeys(self.forms[random.choice(self.words)] for i in range(count))
+        return ' '.join(seeds)
+
+    def most_common(self, count=5):
+        return self.counts.most_common(count)
@@ -0,0 +1,90 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+
+import workers
+
+# guild settings kept between restarts in a sqlite database, one row of json per guild. changes are queued and written
+# together in one transaction flush_delay seconds after the first one, so a burst of commands is a single write, made
+# in the worker pool as it can wait on other shards. the database is in wal mode, so reading it never waits on a write
+flush_delay = 5
+
+
+class SettingsStore:
+
+    def __init__(self, path='settings.db'):
+        self.path = path
+        self.pending = {}
+        self.flushing = False
+        self.write_lock = threading.Lock()
+
+        # shards share the database, so a write waits for another process's to finish instead of failing
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS guilds '
+                                    '(guild_id INTEGER PRIMARY KEY, settings TEXT NOT NULL, updated REAL NOT NULL)')
+
+    # every guild's saved settings, in one query. shard is (shard_id, shard_count) to only get that shard's guilds
+    def load_all(self, shard=None):
+        if shard is None:
+            rows = self.connection.execute('SELECT guild_id, settings FROM guilds')
+        else:
+            rows = self.connection.execute('SELECT guild_id, settings FROM guilds WHERE ((guild_id >> 22) % ?) = ?',
+                                           (shard[1], shard[0]))
+
+        return {guild_id: json.loads(settings) for guild_id, settings in rows}
+
+    def save(self, guild_id, settings):
+        self.pending[guild_id] = settings
+
+    # writes the queued settings, returning how many guilds were written
+    def flush(self):
+        return self.write(self.take_pending())
+
+    def take_pending(self):
+        pending, self.pending = self.pending, {}
+        return pending
+
+    # writes pending (guild ids to settings), returning how many guilds were written. if the write fails they're queued
+    # again, unless newer settings were queued for the guild since
+    def write(self, pending):
+        if not pending:
+            return 0
+
+        now = time.time()
+        rows = [(guild_id, json.dumps(settings), now) for guild_id, settings in pending.items()]
+
+        try:
+            with self.write_lock, self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO guilds VALUES (?, ?, ?)', rows)
+        except:
+            for guild_id, settings in pending.items():
+                self.pending.setdefault(guild_id, settings)
+            raise
+
+        return len(rows)
+
+    def schedule_flush(self):
+        if not self.flushing:
+            self.flushing = True
+            asyncio.ensure_future(self.flush_later())
+
+    async def flush_later(self):
+        try:
+            await asyncio.sleep(flush_delay)
+        finally:
+            self.flushing = False
+
+        try:
+            await workers.run(self.write, self.take_pending())
+        except:
+            # the settings are back in the queue, so try again later
+            self.schedule_flush()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
@@ -0,0 +1,63 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+
+# runs the bot as shard_count processes, one discord shard each. discord sends each shard the events of its own
+# guilds, so every process only loads and generates for its share of them, on its own core. the processes share the
+# settings database, the cached data sets and the model snapshots (which they map, so the pages are shared too).
+# i.e. `python shards.py 4`, or SHARD_COUNT=4, defaulting to one shard per core
+
+
+# starts every shard, identify_delay seconds apart as discord only lets a bot connect a shard every few seconds, and
+# restarts any shard that exits until told to stop
+def launch(shard_count, identify_delay=5, restart_delay=5):
+    main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    processes = {}
+    stopping = False
+
+    def start(shard_id):
+        env = dict(os.environ, SHARD_ID=str(shard_id), SHARD_COUNT=str(shard_count))
+        processes[shard_id] = subprocess.Popen([sys.executable, main_path], env=env)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+        for process in processes.values():
+            if process.poll() is None:
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for shard_id in range(shard_count):
+        if stopping:
+            break
+
+        start(shard_id)
+        time.sleep(identify_delay)
+
+    while not stopping:
+        for shard_id, process in list(processes.items()):
+            if (process.poll() is not None) and (not stopping):
+                print(f'shard {shard_id} exited with {process.returncode}, restarting')
+                time.sleep(restart_delay)
+
+                if not stopping:
+                    start(shard_id)
+
+        time.sleep(1)
+
+    for process in processes.values():
+        process.wait()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    else:
+        count = int(os.getenv('SHARD_COUNT') or os.cpu_count() or 1)
+
+    launch(count)
@@ -0,0 +1,111 @@
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from chain import FrozenChain, Vocab
+
+# binary model snapshots: a json header describing each section, then the sections, each a flat array or a utf-8 blob
+# starting on an 8 byte boundary. loading maps the file and reads the chain arrays in place, so a snapshot loads in
+# about the time it takes to rebuild the vocab, and processes loading the same file share its pages
+MAGIC = b'LGXSNAP1'
+VERSION = 1
+HEADER = struct.Struct('<8sQ')
+ALIGN = 8
+
+
+def pad(length):
+    return -length % ALIGN
+
+
+# writes text (a model.Text) to path. the file is written next to it and swapped in, so processes that have the old
+# snapshot mapped keep reading the old one, and processes writing the same snapshot at once don't mix their writes
+def save(text, path):
+    vocab_offsets = array('q', [0])
+    vocab_blob = bytearray()
+    for token in text.chain.vocab.tokens:
+        vocab_blob += token.encode('utf-8')
+        vocab_offsets.append(len(vocab_blob))
+
+    rejoined_text, sentence_offsets = text.sentence_data()
+
+    sections = [('vocab_offsets', vocab_offsets), ('vocab', vocab_blob), ('sentence_offsets', sentence_offsets),
+                ('text', rejoined_text.encode('utf-8'))]
+    chains = {}
+
+    for name, chain in (('chain', text.chain), ('reverse_chain', text.reverse_chain)):
+        if chain is None:
+            continue
+
+        if not chain.frozen:
+            chain = chain.freeze()
+
+        chains[name] = {'transition_count': chain.transition_count, 'indexed': chain.indexed}
+        sections += [(f'{name}.{a}', getattr(chain, a)) for a in FrozenChain.arrays]
+
+    header = {'version': VERSION, 'byteorder': sys.byteorder, 'state_size': text.state_size,
+              'well_formed': text.well_formed, 'chains': chains, 'sections': {}}
+
+    offset = 0
+    data = []
+    for name, values in sections:
+        values = bytes(memoryview(values).cast('B'))
+        header['sections'][name] = [offset, len(values)]
+        data.append(values + bytes(pad(len(values))))
+        offset += len(values) + pad(len(values))
+
+    header_json = json.dumps(header).encode('utf-8')
+    header_json += b' ' * pad(HEADER.size + len(header_json))
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(header_json)))
+        f.write(header_json)
+        for values in data:
+            f.write(values)
+
+    os.replace(tmp_path, path)
+
+
+# maps the snapshot at path and returns it as a frozen model.Text whose chain arrays are views of the file
+def load(path, text_class):
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    view = memoryview(mapped)
+    magic, header_length = HEADER.unpack(view[:HEADER.size])
+    if magic != MAGIC:
+        raise ValueError(f'{path} is not a model snapshot')
+
+    header = json.loads(bytes(view[HEADER.size:HEADER.size + header_length]))
+    if header['version'] != VERSION or header['byteorder'] != sys.byteorder:
+        raise ValueError(f'{path} was written by an incompatible version or machine')
+
+    start = HEADER.size + header_length
+
+    def section(name):
+        offset, length = header['sections'][name]
+        return view[start + offset:start + offset + length]
+
+    vocab_offsets = section('vocab_offsets').cast('q')
+    vocab_blob = bytes(section('vocab'))
+    vocab = Vocab.from_tokens(vocab_blob[vocab_offsets[i]:vocab_offsets[i + 1]].decode('utf-8')
+                              for i in range(len(vocab_offsets) - 1))
+
+    chains = {}
+    for name, info in header['chains'].items():
+        arrays = {a: section(f'{name}.{a}').cast('q') for a in FrozenChain.arrays}
+        chains[name] = FrozenChain.from_arrays(header['state_size'], vocab, arrays, info['transition_count'],
+                                               info['indexed'])
+
+    text = text_class(None, state_size=header['state_size'], chain=chains['chain'], well_formed=header['well_formed'])
+    text.reverse_chain = chains.get('reverse_chain')
+
+    # sentences are only ever appended to, so they're copied out of the file
+    text.sentence_offsets = array('q', section('sentence_offsets').cast('q'))
+    text.rejoined_text = str(section('text'), 'utf-8')
+    text.text_length = len(text.rejoined_text)
+
+    return text
@@ -0,0 +1,24 @@
+import asyncio
+import concurrent.futures
+import functools
+
+# shared pool that runs model training and generation off the event loop. markov walks are pure python, so threads
+# keep the event loop responsive rather than adding cores; each guild's work is serialized by its bot's lock
+pool = None
+
+
+def configure(max_workers=None):
+    global pool
+
+    if pool is not None:
+        pool.shutdown(wait=False)
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='lgx-worker')
+
+
+async def run(func, *args, **kwargs):
+    if pool is None:
+        configure()
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, functools.partial(func, *args, **kwargs))